@@ -12,6 +12,21 @@ from cloud_common.cc.google import env_vars
 from cloud_common.cc.google import queries
 
 bigquery_client = bigquery.Client()
+__table = None # the data_insert() table, fetched once
+
+
+# ------------------------------------------------------------------------------
+# Private, returns the table that data_insert() writes to.  
+# The table (and its schema) is only fetched once, saving an API round trip
+# on every insert.
+def __get_table():
+    global __table
+    if __table is None:
+        dataset_ref = bigquery_client.dataset(env_vars.bq_dataset, 
+                project=env_vars.cloud_project_id)
+        table_ref = dataset_ref.table(env_vars.bq_table)
+        __table = bigquery_client.get_table(table_ref)
+    return __table
 
 
 # ------------------------------------------------------------------------------
@@ -24,7 +39,7 @@ def get_temp_and_humidity_history_from_BQ(device_uuid):
         'RH': humidity_array,
         'temp': temp_array
     }
-    if device_uuid is None or device_uuid is 'None':
+    if device_uuid in (None, 'None'):
         return result_json
 
     job_config = bigquery.QueryJobConfig()
@@ -53,15 +68,10 @@ def get_temp_and_humidity_history_from_BQ(device_uuid):
 # Insert data into our bigquery dataset and table.
 def data_insert(rowsList):
     try:
-        logging.info("bq insert rows: {}".format(rowsList))
-
-        dataset_ref = bigquery_client.dataset(env_vars.bq_dataset, 
-                project=env_vars.cloud_project_id)
-        table_ref = dataset_ref.table(env_vars.bq_table)
-        table = bigquery_client.get_table(table_ref )               
+        logging.info("bq insert rows: %s", rowsList) # only formatted if logged
 
-        response = bigquery_client.insert_rows(table, rowsList)
-        logging.debug('bq response: {}'.format(response ))
+        response = bigquery_client.insert_rows(__get_table(), rowsList)
+        logging.debug("bq response: %s", response)
 
         return True
 
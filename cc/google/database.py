@@ -1,11 +1,84 @@
 # All common database code.
 import json
-from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 
 from cloud_common.cc import utils
 from cloud_common.cc.google import datastore
 
 
+# Keys of the DeviceData dicts we read.
+DD_timestamp_KEY = "timestamp"
+DD_value_KEY = "value"
+
+# Keys of the dicts we return (one per history row).
+time_KEY = "time"
+value_KEY = "value"
+RH_KEY = "RH"
+temp_KEY = "temp"
+
+# Dashboards ask for the same DeviceData history many times in a few seconds
+# (one request per panel, retries), so keep the history query results for a
+# short time.  Each entry can be a thousand rows, so only keep a few.
+__device_data_cache = utils.TTLCache(maxsize=100, ttl=5)
+
+
+# ------------------------------------------------------------------------------
+# Private helper to get DeviceData[key] for this device, history (count > 1)
+# is cached for a few seconds.  The caller gets its own copy of the rows.
+# The newest value (count == 1) is already cached by datastore.
+def __get_device_data(key, device_uuid, count):
+    if 1 == count:
+        return datastore.get_device_data(key, device_uuid, count=count)
+    cache_key = (key, device_uuid, count)
+    vals = __device_data_cache.get(cache_key)
+    if vals is None:
+        vals = datastore.get_device_data(key, device_uuid, count=count)
+        __device_data_cache.set(cache_key, vals)
+    return [dict(v) for v in vals]
+
+
+# ------------------------------------------------------------------------------
+# Private helper to get all the horticulture log entries for this device.
+# Returns a list of entities.
+def __get_horticulture_log(device_uuid):
+    query = datastore.get_client().query(kind=datastore.DS_horticulture_log_KEY)
+    query.add_filter("device_uuid", "=", device_uuid)
+    return list(query.fetch())
+
+
+# ------------------------------------------------------------------------------
+# Private helper to convert DeviceData values into a list of time / value
+# dicts, keeping only the values in the (inclusive) start / end range.
+# Pass None for start_timestamp to keep all values.
+# Our timestamps are fixed width UTC strings, so comparing the strings
+# is the same as comparing the times (and much faster than parsing them).
+def __get_series_in_range(vals, start_timestamp, end_timestamp):
+    series = []
+    for val in vals:
+        ts_str = utils.bytes_to_string(val[DD_timestamp_KEY])
+        if start_timestamp is not None and (
+            ts_str < start_timestamp or ts_str > end_timestamp
+        ):
+            continue  # this value is not in our start / end range
+        # make sure the time column is the first entry in each dict
+        series.append(
+            {time_KEY: ts_str, value_KEY: utils.bytes_to_string(val[DD_value_KEY])}
+        )
+    return series
+
+
+# ------------------------------------------------------------------------------
+# Private helper to convert DeviceData values into value / time dicts.
+# (The order of the keys is what the history getters have always returned.)
+# Returns a generator.
+def __iter_value_series(vals):
+    for val in vals:
+        yield {
+            value_KEY: utils.bytes_to_string(val[DD_value_KEY]),
+            time_KEY: utils.bytes_to_string(val[DD_timestamp_KEY]),
+        }
+
+
 # ------------------------------------------------------------------------------
 # Get the historical Temp, Humidity, CO2, leaf count, plant height values as
 # time series in a date range for this device.
@@ -19,74 +92,64 @@ def get_all_historical_values(device_uuid, start_timestamp, end_timestamp):
     plant_height = []
     horticulture_notes = []
 
-    if device_uuid is None or device_uuid is "None":
+    if device_uuid in (None, "None"):
         print(f"get_all_historical_values: No device_uuid")
         return temp, RH, co2, leaf_count, plant_height
 
-    co2_vals = datastore.get_device_data(datastore.DS_co2_KEY, device_uuid, count=1000)
-    temp_vals = datastore.get_device_data(
-        datastore.DS_temp_KEY, device_uuid, count=1000
-    )
-    rh_vals = datastore.get_device_data(datastore.DS_rh_KEY, device_uuid, count=1000)
-    if 0 == len(co2_vals) and 0 == len(temp_vals) and 0 == len(rh_vals):
-        print(f"get_all_historical_values: No DeviceData for {device_uuid}")
-        return temp, RH, co2, leaf_count, plant_height
-
     # handle None values for date range, in which case we return all
     start, end = None, None
     try:
-        start = dt.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        end = dt.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        start = utils.utc_timestamp_to_datetime(start_timestamp)
+        end = utils.utc_timestamp_to_datetime(end_timestamp)
         print(
             f"get_all_historical_values: using date range: {str(start)} to {str(end)}"
         )
     except:
         start, end = None, None
+        start_timestamp, end_timestamp = None, None
         print(f"get_all_historical_values: no date range")
 
-    # make sure the time column is the first entry in each dict
-    for val in co2_vals:
-        ts_str = utils.bytes_to_string(val["timestamp"])
-        ts = dt.strptime(ts_str, "%Y-%m-%dT%H:%M:%SZ")
-        if start is not None and end is not None and (ts < start or ts > end):
-            continue  # this value is not in our start / end range
-        value = utils.bytes_to_string(val["value"])
-        co2.append({"time": ts_str, "value": value})
-
-    for val in temp_vals:
-        ts_str = utils.bytes_to_string(val["timestamp"])
-        ts = dt.strptime(ts_str, "%Y-%m-%dT%H:%M:%SZ")
-        if start is not None and end is not None and (ts < start or ts > end):
-            continue  # this value is not in our start / end range
-        value = utils.bytes_to_string(val["value"])
-        temp.append({"time": ts_str, "value": value})
+    # The three DeviceData series and the horticulture log are independent
+    # queries, so run them all at the same time.
+    # The date range is applied in the DeviceData queries, so we only get
+    # back the rows we need.  (The horticulture log is filtered below, a
+    # range filter on it would need another composite index.)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        hort_future = executor.submit(__get_horticulture_log, device_uuid)
+        series = datastore.get_device_data_multi(
+            [datastore.DS_co2_KEY, datastore.DS_temp_KEY, datastore.DS_rh_KEY],
+            device_uuid,
+            count=1000,
+            start=start_timestamp,
+            end=end_timestamp,
+        )
+        query_result = hort_future.result()
+    co2_vals = series[datastore.DS_co2_KEY]
+    temp_vals = series[datastore.DS_temp_KEY]
+    rh_vals = series[datastore.DS_rh_KEY]
+    if 0 == len(co2_vals) and 0 == len(temp_vals) and 0 == len(rh_vals):
+        print(f"get_all_historical_values: No DeviceData for {device_uuid}")
+        return temp, RH, co2, leaf_count, plant_height
 
-    for val in rh_vals:
-        ts_str = utils.bytes_to_string(val["timestamp"])
-        ts = dt.strptime(ts_str, "%Y-%m-%dT%H:%M:%SZ")
-        if start is not None and end is not None and (ts < start or ts > end):
-            continue  # this value is not in our start / end range
-        value = utils.bytes_to_string(val["value"])
-        RH.append({"time": ts_str, "value": value})
+    co2 = __get_series_in_range(co2_vals, start_timestamp, end_timestamp)
+    temp = __get_series_in_range(temp_vals, start_timestamp, end_timestamp)
+    RH = __get_series_in_range(rh_vals, start_timestamp, end_timestamp)
 
-    # get horticulture measurements: leaf_count, plant_height
-    query = datastore.get_client().query(kind="DailyHorticultureLog")
-    query.add_filter("device_uuid", "=", device_uuid)
-    query_result = list(query.fetch())
+    # horticulture measurements: leaf_count, plant_height
     if 0 < len(query_result):
         for result in query_result:
             ts_str = str(utils.bytes_to_string(result["submitted_at"]))
             ts_str = ts_str.split(".")[0]
             try:
-                ts = dt.strptime(ts_str, "%Y-%m-%dT%H:%M:%SZ")
+                ts = utils.utc_timestamp_to_datetime(ts_str)
                 if start is not None and end is not None and (ts < start or ts > end):
                     continue  # this value is not in our start / end range
                 if "leaf_count" in result:
-                    leaf_count.append({"time": ts_str, "value": result["leaf_count"]})
+                    leaf_count.append({time_KEY: ts_str, value_KEY: result["leaf_count"]})
                 if "plant_height" in result:
-                    plant_height.append({"time": ts_str, "value": result["plant_height"]})
+                    plant_height.append({time_KEY: ts_str, value_KEY: result["plant_height"]})
                 if "horticulture_notes" in result:
-                    horticulture_notes.append({"time": ts_str, "value": result["horticulture_notes"]})
+                    horticulture_notes.append({time_KEY: ts_str, value_KEY: result["horticulture_notes"]})
 
             except:
                 print("Invalid string format:", ts_str)
@@ -99,100 +162,114 @@ def get_all_historical_values(device_uuid, start_timestamp, end_timestamp):
 # Get the historical CO2 values for this device.
 # Returns a list.
 def get_co2_history(device_uuid):
-    if device_uuid is None or device_uuid is "None":
-        return []
-
-    co2_vals = datastore.get_device_data(datastore.DS_co2_KEY, device_uuid, count=1000)
-    if 0 == len(co2_vals):
-        return []
-
-    results = []
-    for val in co2_vals:
-        ts = utils.bytes_to_string(val["timestamp"])
-        value = utils.bytes_to_string(val["value"])
-        results.append({"value": value, "time": ts})
-    return results
+    return list(iter_co2_history(device_uuid))
+
+
+# ------------------------------------------------------------------------------
+# Iterate the historical CO2 values for this device, one time / value dict at
+# a time.  For callers that stream the rows out (CSV, JSON lines) and don't
+# need the whole list in memory.
+# Returns a generator.
+def iter_co2_history(device_uuid):
+    if device_uuid in (None, "None"):
+        return
+
+    co2_vals = __get_device_data(datastore.DS_co2_KEY, device_uuid, 1000)
+    yield from __iter_value_series(co2_vals)
 
 
 # ------------------------------------------------------------------------------
 # Get a list of the led panel historical values.
 # Returns a list.
 def get_led_panel_history(device_uuid):
-    if device_uuid is None or device_uuid is "None":
-        return []
+    return list(iter_led_panel_history(device_uuid))
+
 
-    led_vals = datastore.get_device_data(datastore.DS_led_KEY, device_uuid, count=1000)
-    if 0 == len(led_vals):
-        return []
+# ------------------------------------------------------------------------------
+# Iterate the led panel historical values, one value at a time.
+# Returns a generator.
+def iter_led_panel_history(device_uuid):
+    if device_uuid in (None, "None"):
+        return
 
-    results = []
+    led_vals = __get_device_data(datastore.DS_led_KEY, device_uuid, 1000)
     for val in led_vals:
-        led_json = utils.bytes_to_string(val["value"])
-        results.append(led_json)
-    return results
+        yield utils.bytes_to_string(val[DD_value_KEY])
 
 
 # ------------------------------------------------------------------------------
 # Get a dict with two arrays of the temp and humidity historical values.
 # Returns a dict.
 def get_temp_and_humidity_history(device_uuid):
-    humidity_array = []
-    temp_array = []
-    result_json = {"RH": humidity_array, "temp": temp_array}
-    if device_uuid is None or device_uuid is "None":
+    result_json = {RH_KEY: [], temp_KEY: []}
+    if device_uuid in (None, "None"):
         return result_json
 
-    temp_vals = datastore.get_device_data(
-        datastore.DS_temp_KEY, device_uuid, count=1000
-    )
-    rh_vals = datastore.get_device_data(datastore.DS_rh_KEY, device_uuid, count=1000)
-    if 0 == len(temp_vals) or 0 == len(rh_vals):
+    # We return nothing unless both series have values, so don't bother
+    # querying RH when there is no temp.
+    temp_vals = __get_device_data(datastore.DS_temp_KEY, device_uuid, 1000)
+    if 0 == len(temp_vals):
+        return result_json
+    rh_vals = __get_device_data(datastore.DS_rh_KEY, device_uuid, 1000)
+    if 0 == len(rh_vals):
         return result_json
 
-    for val in temp_vals:
-        ts = utils.bytes_to_string(val["timestamp"])
-        value = utils.bytes_to_string(val["value"])
-        result_json["temp"].append({"value": value, "time": ts})
-
-    for val in rh_vals:
-        ts = utils.bytes_to_string(val["timestamp"])
-        value = utils.bytes_to_string(val["value"])
-        result_json["RH"].append({"value": value, "time": ts})
-
+    result_json[temp_KEY] = list(__iter_value_series(temp_vals))
+    result_json[RH_KEY] = list(__iter_value_series(rh_vals))
     return result_json
 
 
 # ------------------------------------------------------------------------------
 # Generic function to return a float value from DeviceData[key]
 def get_current_float_value_from_DS(key, device_uuid):
-    if device_uuid is None or device_uuid is "None":
+    if device_uuid in (None, "None"):
         return ""
 
-    vals = datastore.get_device_data(key, device_uuid, count=1)
+    vals = __get_device_data(key, device_uuid, 1)
     if 0 == len(vals):
         return ""
 
     # process the vars list from the DS into the same format as BQ
     result = ""
     val = vals[0]  # the first item in the list is most recent
-    result = "{0:.2f}".format(float(val["value"]))
+    result = format(float(val[DD_value_KEY]), ".2f")
     return result
 
 
+# ------------------------------------------------------------------------------
+# Get the current float values of many DeviceData keys at once, for example
+# all the values on a dashboard.  The Datastore queries run in parallel.
+# Returns a dict of {key: value}, values are formatted like
+# get_current_float_value_from_DS() (and "" if there is no value).
+def get_current_values(device_uuid, keys):
+    if device_uuid in (None, "None"):
+        return {key: "" for key in keys}
+
+    results = {}
+    all_vals = datastore.get_device_data_multi(keys, device_uuid, count=1)
+    for key, vals in all_vals.items():
+        if 0 == len(vals):
+            results[key] = ""
+            continue
+        val = vals[0]  # the first item in the list is most recent
+        results[key] = format(float(val[DD_value_KEY]), ".2f")
+    return results
+
+
 # ------------------------------------------------------------------------------
 # Generic function to return a float value and timestamp from DeviceData[key]
 def get_current_float_value_and_timestamp_from_DS(key, device_uuid):
-    if device_uuid is None or device_uuid is "None":
+    if device_uuid in (None, "None"):
         return {"value": None, "timestamp": None}
 
-    vals = datastore.get_device_data(key, device_uuid, count=1)
+    vals = __get_device_data(key, device_uuid, 1)
     if 0 == len(vals):
         return {"value": None, "timestamp": None}
 
     # process the vars list from the DS into the same format as BQ
     result = ""
     val = vals[0]  # the first item in the list is most recent
-    value = "{0:.2f}".format(float(val["value"]))
+    value = format(float(val[DD_value_KEY]), ".2f")
     timestamp = val.get("timestamp")
     return {"value": value, "timestamp": timestamp}
 
@@ -201,10 +278,10 @@ def get_current_float_value_and_timestamp_from_DS(key, device_uuid):
 # Generic function to return a dict value from DeviceData[key]
 def get_current_json_value_from_DS(key, device_uuid):
     result = {}
-    if device_uuid is None or device_uuid is "None":
+    if device_uuid in (None, "None"):
         return json.dumps(result)
 
-    vals = datastore.get_device_data(key, device_uuid, count=1)
+    vals = __get_device_data(key, device_uuid, 1)
     if 0 == len(vals):
         return json.dumps(result)
 
@@ -349,10 +426,8 @@ def get_current_horticulture_log(device_uuid):
     horticulture_notes = None
 
     # Query datastore
-    query = datastore.get_client().query(kind="DailyHorticultureLog")
-    query.add_filter("device_uuid", "=", device_uuid)
-    query_result = list(query.fetch())
-    
+    query_result = __get_horticulture_log(device_uuid)
+
     # Validate results
     if len(query_result) == 0:
         return {"leaf_count": None, "plant_height": None, "submitted_at": None, "horticulture_notes": None}
@@ -2,7 +2,8 @@
 
 import traceback
 import datetime as dt
-import uuid, json, logging, time, sys
+import uuid, json, logging, sys, threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, List, Dict
 
 from google.cloud import datastore
@@ -34,6 +35,8 @@ DS_hort_KIND = 'HorticultureMeasurements'
 DS_turds_KIND = 'MqttServiceTurds'
 DS_cache_KIND = 'MqttServiceCache'
 DS_images_KIND = 'Images'
+DS_latest_KIND = 'Latest' # keyed by sharded kind, holds its newest data
+DS_latest_image_KIND = 'LatestImage' # keyed by device_uuid
 
 # Property names for DeviceData entities
 DS_device_uuid_KEY = 'device_uuid'
@@ -60,12 +63,31 @@ DS_schedule_KEY = 'schedule'
 
 # Global
 __ds_client = None
+__ds_client_lock = threading.Lock()
+__devices_cache = utils.TTLCache(maxsize=10000, ttl=60) # device_uuid: ent
+__latest_cache = utils.TTLCache(maxsize=10000, ttl=5) # sharded kind: data
+__no_rows_cache = utils.TTLCache(maxsize=10000, ttl=60) # sharded kind: True
+# DeviceData properties that are never read as the newest value (count=1),
+# so their saves don't write a Latest entity.
+__no_latest_properties = frozenset((DS_schedule_KEY, DS_notifications_KEY))
 
 
 def __name() -> str:
     return 'cloud_common.cc.google.datastore'
 
 
+#------------------------------------------------------------------------------
+# Private, returns True if saves of this sharded kind's property keep a 
+# Latest entity: the DeviceData properties that are read with count=1.
+# Reads of the newest value trust the Latest entity, so every write of these
+# rows must go through save_dict_to_entity() (save_device_data()),
+# replace_device_data() or put_sharded_entity(), which keep it current.
+# Don't put or delete these rows directly.
+def __keeps_latest(entity_kind: str, property_name: str) -> bool:
+    return entity_kind == DS_device_data_KIND and \
+            property_name not in __no_latest_properties
+
+
 #------------------------------------------------------------------------------
 # Datastore client for google cloud
 def create_client() -> Any:
@@ -74,10 +96,13 @@ def create_client() -> Any:
 
 
 #------------------------------------------------------------------------------
+# Thread safe, only one client is ever created (we query from many threads).
 def get_client() -> Any:
     global __ds_client 
     if __ds_client is None:
-        __ds_client = create_client()
+        with __ds_client_lock:
+            if __ds_client is None: # another thread may have created it
+                __ds_client = create_client()
     return __ds_client
 
 
@@ -92,7 +117,7 @@ def get_count_of_entities_from_DS():
     res[DS_cache_KIND] = get_entity_count_from_DS(DS_cache_KIND)
     res[DS_turds_KIND] = get_entity_count_from_DS(DS_turds_KIND)
     res['DeviceDataLastHour'] = get_DeviceData_active_last_hour_count_from_DS()
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
@@ -111,8 +136,8 @@ def get_entity_count_from_DS(kind):
         return 0
     query = DS.query(kind=kind)
     query.keys_only() # retuns less data, so faster
-    entities = list(query.fetch()) # get all entities (keys only)
-    return len(entities)
+    # Count the keys as the pages arrive, instead of keeping them all.
+    return sum(1 for _ in query.fetch())
 
 
 #------------------------------------------------------------------------------
@@ -157,6 +182,26 @@ def get_sharded_entities(kind: str, property_name: str, device_key: str,
     return list(query.fetch(limit=count)) # get count number of rows
 
 
+#------------------------------------------------------------------------------
+# Return a list of up to count sharded entities whose DATA dict has 
+# data_key <op> value (op is a datastore filter operator such as '=' or '<=').
+# The filter is done by the datastore, so only the matching entities are 
+# returned.
+# Not sorted: every sharded kind is different, so there can't be a composite
+# index on (data_key, timestamp).  The built in single property index is 
+# used.
+def get_sharded_entities_by_data_value(kind: str, property_name: str, 
+        device_key: str, data_key: str, value, count: int = None, 
+        op: str = '='):
+    DS = get_client()
+    if DS is None:
+        return []
+    kind = get_sharded_kind(kind, property_name, device_key)
+    query = DS.query(kind=kind)
+    query.add_filter(f'{DS_DeviceData_data_Property}.{data_key}', op, value)
+    return list(query.fetch(limit=count))
+
+
 #------------------------------------------------------------------------------
 # Return count rows of DATA for this property and device key.
 # Count can be None to get all rows.
@@ -164,11 +209,7 @@ def get_sharded_entity(kind: str, property_name: str, device_key: str,
         count: int = None):
     entities = get_sharded_entities(kind, property_name, device_key, count)
     logging.debug(f'{__name()} get_sharded_entity: count={len(entities)}')
-    ret = []
-    for e in entities:
-        data = e.get(DS_DeviceData_data_Property, {})
-        ret.append(data)
-    return ret
+    return [e.get(DS_DeviceData_data_Property, {}) for e in entities]
 
 
 #------------------------------------------------------------------------------
@@ -189,58 +230,195 @@ def get_sharded_entity_range(kind: str, property_name: str, device_key: str,
     query.add_filter(DS_DeviceData_timestamp_Property, '<=', end_date)
     entities = list(query.fetch(limit=count)) # get count number of rows
     logging.debug(f'{__name()} get_sharded_entity_range: count={len(entities)}')
-    ret = []
-    for e in entities:
-        data = e.get(DS_DeviceData_data_Property, {})
-        ret.append(data)
-    return ret
+    return [e.get(DS_DeviceData_data_Property, {}) for e in entities]
 
 
 #------------------------------------------------------------------------------
 # Return count rows of data for this property and device.
 # Count can be None to get all rows.
-def get_device_data(property_name: str, device_uuid: str, count: int = None):
-    ret = get_sharded_entity(DS_device_data_KIND, property_name, device_uuid,
-            count)
+# Start and end are optional (inclusive) UTC '%FT%XZ' timestamps, pass both
+# to only get the rows in that range.
+def get_device_data(property_name: str, device_uuid: str, count: int = None,
+        start: str = None, end: str = None):
+    # The most common read is just the newest value, which we can get by key.
+    if 1 == count and start is None and end is None and \
+            __keeps_latest(DS_device_data_KIND, property_name):
+        latest = get_latest_device_data([property_name], device_uuid)
+        if property_name in latest:
+            return [latest[property_name]]
+        return __query_latest_device_data(property_name, device_uuid)
+    if start is not None and end is not None:
+        # The entity timestamp is written with isoformat() (no 'Z'), so the 
+        # 'Z' is removed from start and kept on end, which makes both ends 
+        # include their whole second.
+        ret = get_sharded_entity_range(DS_device_data_KIND, property_name, 
+                device_uuid, start.rstrip('Z'), end, count)
+    else:
+        ret = get_sharded_entity(DS_device_data_KIND, property_name, 
+                device_uuid, count)
     logging.debug(f'{__name()} get_device_data: count={len(ret)}')
     return ret
 
+
 #------------------------------------------------------------------------------
-# Private helper for function below.
-def __add_latest_property_to_dict(device_uuid: str, key: str, rdict: dict):
-    var = get_device_data(key, device_uuid, count=1)
-    val = ''
-    if 0 < len(var):
-        var = var[0]
-        val = var.get("value", '')
-    rdict[key] = val
+# Return a dict of {key: get(key),...} for each of the (unique) keys.
+# For reads of sharded kinds, each key is its own kind, so the queries are
+# independent and we run them in parallel (the total time is the slowest 
+# query, not the sum).
+# Each key gets an empty list if there is no datastore client.
+def get_in_parallel(keys: List[str], get) -> Dict[str, Any]:
+    keys = list(dict.fromkeys(keys)) # unique, in order
+    if 0 == len(keys):
+        return {}
+    # Create the client before we start threads, so they all share it.
+    if get_client() is None:
+        return {k: [] for k in keys}
+    with ThreadPoolExecutor(max_workers=min(len(keys), 32)) as executor:
+        futures = {k: executor.submit(get, k) for k in keys}
+        return {k: f.result() for k, f in futures.items()}
+
 
-def __add_boot_time_to_dict(device_uuid: str, rdict: dict):
-    var = get_device_data(DS_boot_KEY, device_uuid, count=1)
-    val = ''
-    if 0 < len(var):
-        var = var[0]
-        val = var.get("timestamp", '')
-    rdict['boot_time'] = val
+#------------------------------------------------------------------------------
+# Return a dict of {'property_name': [rows],...} for each of the properties.
+# The properties are read in parallel, see get_in_parallel().
+# Count can be None to get all rows.
+# Start and end are optional (inclusive) UTC '%FT%XZ' timestamps.
+def get_device_data_multi(property_names: List[str], device_uuid: str,
+        count: int = None, start: str = None, 
+        end: str = None) -> Dict[str, List]:
+    return get_in_parallel(property_names, 
+            lambda p: get_device_data(p, device_uuid, count, start, end))
+
+
+#------------------------------------------------------------------------------
+# Return a dict of {'property_name': data,...} of the most recent data for
+# each property of this device, from the Latest entities that the device
+# data writers keep current (see __keeps_latest()).  One get_multi() call,
+# no queries.
+# The data is cached (and written through by saves in this process) for a
+# few seconds, the caller gets its own copy of each dict.
+# Properties that have no Latest entity (not written since we started
+# keeping them) are not in the dict.
+def get_latest_device_data(property_names: List[str], 
+        device_uuid: str) -> Dict[str, Dict]:
+    DS = get_client()
+    if DS is None:
+        return {}
+    kinds = {get_device_data_kind(p, device_uuid): p for p in property_names}
+    ret = {}
+    missing = [] # kinds not in our cache
+    for kind, p in kinds.items():
+        data = __latest_cache.get(kind)
+        if data is None:
+            missing.append(kind)
+        else:
+            ret[p] = dict(data)
+    if 0 == len(missing):
+        return ret
+    entities = DS.get_multi([DS.key(DS_latest_KIND, k) for k in missing])
+    # get_multi() does not return the entities in the order of the keys.
+    for e in entities:
+        data = e.get(DS_DeviceData_data_Property, {})
+        __latest_cache.set(e.key.name, data)
+        ret[kinds[e.key.name]] = dict(data)
+    return ret
+
+
+#------------------------------------------------------------------------------
+# Private helper for a property that has no Latest entity.  Queries for its
+# newest row and returns it as a list of zero or one data dicts.
+# The row is copied to a Latest entity (rows saved before we kept them), so 
+# the next read gets it by key.  A property with no rows is remembered for a
+# while, so we don't query for it on every read.
+def __query_latest_device_data(property_name: str, 
+        device_uuid: str) -> List[Dict]:
+    if get_client() is None:
+        return []
+    keeps_latest = __keeps_latest(DS_device_data_KIND, property_name)
+    kind = get_device_data_kind(property_name, device_uuid)
+    if keeps_latest and __no_rows_cache.get(kind) is not None:
+        return []
+    entities = get_sharded_entities(DS_device_data_KIND, property_name, 
+            device_uuid, 1)
+    if 0 == len(entities):
+        if keeps_latest: # (a save will write its Latest entity)
+            __no_rows_cache.set(kind, True)
+        return []
+    data = entities[0].get(DS_DeviceData_data_Property, {})
+    if keeps_latest:
+        try:
+            __put_latest_if_newer(entities[0], create=True)
+        except Exception as e:
+            logging.error(f'{__name()} __query_latest_device_data: {e}')
+    return [dict(data)]
+
+
+#------------------------------------------------------------------------------
+# Private helper to make a sharded data entity (row) the Latest entity of its
+# kind, unless the Latest entity already holds a newer row.  Done in a 
+# transaction, so we never replace the newer data of a save that got there 
+# first.  Set put_row to also put the row itself, in the same transaction.
+# With create False a kind that has no Latest entity doesn't get one, there
+# may be a newer row we haven't read (the next newest value read backfills 
+# it from a query).
+def __put_latest_if_newer(row, create: bool, put_row: bool = False) -> None:
+    DS = get_client()
+    kind = row.key.kind
+    data = row.get(DS_DeviceData_data_Property, {})
+    timestamp = row.get(DS_DeviceData_timestamp_Property) or ''
+    key = DS.key(DS_latest_KIND, kind)
+    with DS.transaction():
+        latest = DS.get(key) # (read in the transaction)
+        if latest is None:
+            is_newest = create
+            latest = datastore.Entity(key)
+        else:
+            is_newest = timestamp >= \
+                    (latest.get(DS_DeviceData_timestamp_Property) or '')
+        entities = [row] if put_row else []
+        if is_newest:
+            latest[DS_DeviceData_data_Property] = data
+            latest[DS_DeviceData_timestamp_Property] = timestamp
+            entities.append(latest)
+        if 0 < len(entities):
+            DS.put_multi(entities)
+    if is_newest:
+        __latest_cache.set(kind, dict(data)) # write through (a copy)
+
+
+#------------------------------------------------------------------------------
+# Private helper to return a dict of {'property_name': data,...} of the
+# newest data row for each property that has one.
+# Reads the Latest entities, then queries (in parallel) for any property
+# that has no Latest entity yet.
+def __get_latest_device_data_rows(property_names: List[str], 
+        device_uuid: str) -> Dict[str, Dict]:
+    latest = get_latest_device_data(property_names, device_uuid)
+    missing = [p for p in property_names if p not in latest]
+    if 0 == len(missing):
+        return latest
+    queried = get_in_parallel(missing, 
+            lambda p: __query_latest_device_data(p, device_uuid))
+    for p, vals in queried.items():
+        if 0 < len(vals):
+            latest[p] = vals[0]
+    return latest
 
 
 #------------------------------------------------------------------------------
 # Return a dict of {'property_name':value,...} for all the usual properties.
 # The most recent (by time) values are in the dict.
 def get_all_recent_device_data_properties(device_uuid: str):
-    return_dict = {}
-    __add_boot_time_to_dict(device_uuid, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_boot_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_status_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_co2_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_rh_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_temp_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_led_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_led_dist_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_led_intensity_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_h20_ec_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_h20_ph_KEY, return_dict)
-    __add_latest_property_to_dict(device_uuid, DS_h20_temp_KEY, return_dict)
+    keys = [DS_boot_KEY, DS_status_KEY, DS_co2_KEY, DS_rh_KEY, DS_temp_KEY,
+            DS_led_KEY, DS_led_dist_KEY, DS_led_intensity_KEY, 
+            DS_h20_ec_KEY, DS_h20_ph_KEY, DS_h20_temp_KEY]
+    latest = __get_latest_device_data_rows(keys, device_uuid)
+
+    # The boot time and value come from the same (one) boot row.
+    return_dict = {
+        'boot_time': latest.get(DS_boot_KEY, {}).get("timestamp", '')}
+    for key in keys:
+        return_dict[key] = latest.get(key, {}).get("value", '')
     return return_dict
 
 
@@ -266,11 +444,8 @@ def get_keys(kind) -> List[str]:
         return []
     query = DS.query(kind=kind)
     query.keys_only() # retuns less data, so faster
-    entities = list(query.fetch()) # get all entities (keys only)
-    keys = []
-    for ent in entities:
-        keys.append(ent.key.id_or_name)
-    return keys
+    # Only keep the names, not the entities (keys only).
+    return [ent.key.id_or_name for ent in query.fetch()]
 
 
 #------------------------------------------------------------------------------
@@ -328,16 +503,33 @@ def get_by_key(kind: str, key: str) -> dict:
         return {}
 
 
+#------------------------------------------------------------------------------
+# Private helper to return (a copy of) the Devices entity for this device, 
+# or None.  Devices rarely change, so we remember them for a minute.
+# Not found is not remembered, so a newly registered device is seen right 
+# away, and delete_device_from_DS() forgets the device.
+def __get_device_entity(device_uuid):
+    device = __devices_cache.get(device_uuid)
+    if device is None:
+        DS = get_client()
+        # Devices are auto keyed (by the UI), so query for it.
+        query = DS.query(kind=DS_devices_KIND)
+        query.add_filter('device_uuid', '=', device_uuid)
+        device = next(iter(query.fetch(1)), None) # just get first (no order)
+        if device is None:
+            return None
+        __devices_cache.set(device_uuid, device)
+    return dict(device) # the caller can't change the cached entity
+
+
 #------------------------------------------------------------------------------
 def get_device_name_from_DS(device_uuid):
     DS = get_client()
     if DS is None:
         return "error"
-    query = DS.query(kind=DS_devices_KIND)
-    query.add_filter('device_uuid', '=', device_uuid)
-    results = list(query.fetch(1)) # just get first (no order)
-    if len(results) > 0:
-        return results[0]["device_name"]
+    device = __get_device_entity(device_uuid)
+    if device is not None:
+        return device["device_name"]
     else:
         return "Invalid device"
 
@@ -345,19 +537,15 @@ def get_device_name_from_DS(device_uuid):
 #------------------------------------------------------------------------------
 # Get DeviceData status
 def get_device_data_from_DS(device_uuid):
-    if device_uuid is None or device_uuid is 'None':
-        return None
-
-    temp = get_device_data(DS_temp_KEY, device_uuid, count=1)
-    if 0 == len(temp):
+    if device_uuid in (None, 'None'):
         return None
-    temp = temp[0]
-    air_temperature_celsius = temp.get("value", '')
 
-    status = get_device_data(DS_status_KEY, device_uuid, count=1)
-    if 0 == len(status):
+    latest = __get_latest_device_data_rows([DS_temp_KEY, DS_status_KEY],
+            device_uuid)
+    if DS_temp_KEY not in latest or DS_status_KEY not in latest:
         return None
-    status = status[0]
+    air_temperature_celsius = latest[DS_temp_KEY].get("value", '')
+    status = latest[DS_status_KEY]
 
     result_json = {
         "timestamp": status.get("timestamp", ""),
@@ -377,8 +565,7 @@ def get_count_of_users_devices_from_DS(user_uuid):
     query = DS.query(kind=DS_devices_KIND)
     query.keys_only() # retuns less data, so faster
     query.add_filter('user_uuid', '=', user_uuid)
-    entities = list(query.fetch()) # get all entities (keys only)
-    return len(entities)
+    return sum(1 for _ in query.fetch()) # count the keys as they arrive
 
 
 #------------------------------------------------------------------------------
@@ -393,7 +580,7 @@ def get_list_of_users_from_DS():
     for u in users:
         user = {}
         da = u.get('date_added', '')
-        user["account_creation_date"] = da.strftime('%FT%XZ')
+        user["account_creation_date"] = utils.datetime_to_utc_timestamp(da)
         user["email_address"] = u.get('email_address', '')
         user["user_name"] = u.get('username', '')
         user["user_uuid"] = u.get('user_uuid', '')
@@ -409,7 +596,7 @@ def get_list_of_users_from_DS():
 
         res['users'].append(user)
 
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
@@ -432,198 +619,161 @@ def get_list_of_basic_device_info():
     res = sorted(res, key=lambda d: d.get('device_name'))
     return res
 
+#------------------------------------------------------------------------------
+# Private helper for the device lists, adds the 'remote_URL' and 
+# 'access_point' from the boot DeviceData to the device dict.
+def __add_boot_info_to_dict(boot: Dict, device: Dict):
+    # get latest boot message
+    last_boot = boot.get('value')
+
+    # convert binary into string and then a dict
+    boot_dict = json.loads(utils.bytes_to_string(last_boot))
+
+    # the serveo link needs to be lower case
+    remote_URL = boot_dict.get('remote_URL')
+    if remote_URL is not None:
+        device['remote_URL'] = remote_URL.lower()
+
+    # get the AP, extract just the wifi code
+    access_point = boot_dict.get('access_point')
+    if access_point is not None and access_point.startswith('BeagleBone-'):
+        device['access_point'] = access_point.split('-')[1]
+
+
+#------------------------------------------------------------------------------
+# Private helper to get all the users in one query (instead of one query per
+# device), returns a dict of {user_uuid: user entity}.
+def __get_users_by_uuid() -> Dict:
+    DS = get_client()
+    if DS is None:
+        return {}
+    users = {}
+    for u in DS.query(kind=DS_users_KIND).fetch():
+        users.setdefault(u.get('user_uuid', ''), u)
+    return users
+
+
+#------------------------------------------------------------------------------
+# Private helper for the function below, returns the details of one device.
+def __get_device_details(d, users: Dict) -> Dict:
+    device = {}
+    rd = d.get('registration_date', None) # web ui reg date
+    if rd is None:
+        device['registration_date'] = ''
+    else:
+        device['registration_date'] = utils.datetime_to_utc_timestamp(rd)
+    device['device_name'] = d.get('device_name', '')
+    device['device_notes'] = d.get('device_notes', '')
+    device_uuid = d.get('device_uuid', '')
+    device['device_uuid'] = device_uuid
+    user_uuid = d.get('user_uuid', '')
+    device['user_uuid'] = user_uuid
+    device['last_config_send_time'] = 'Never' # in case no IoT device
+    device['last_error_message'] = 'No IoT registration'
+    device['user_name'] = 'None'
+    if 0 != len(user_uuid):
+        user = users.get(user_uuid)
+        if user is not None:
+            device['user_name'] = user.get('username','None')
+
+    device['remote_URL'] = ''
+    device['access_point'] = ''
+    if 0 < len(device_uuid):
+        dd = get_device_data(DS_boot_KEY, device_uuid, count=1)
+        if 0 < len(dd):
+            __add_boot_info_to_dict(dd[0], device)
+
+    return device
+
+
 #------------------------------------------------------------------------------
 # all the details on each device (sort of slow)
+# Each device needs its own queries, so do the devices in parallel.
 def get_list_of_devices_from_DS():
     res = {}
     DS = get_client()
     if DS is None:
         return res
-    res['devices'] = [] # list of devices
     query = DS.query(kind=DS_devices_KIND)
     devices = list(query.fetch()) # get all devices 
-    for d in devices:
-        device = {}
-        rd = d.get('registration_date', None) # web ui reg date
-        if rd is None:
-            device['registration_date'] = ''
-        else:
-            device['registration_date'] = rd.strftime('%FT%XZ') 
-        device['device_name'] = d.get('device_name', '')
-        device['device_notes'] = d.get('device_notes', '')
-        device_uuid = d.get('device_uuid', '')
-        device['device_uuid'] = device_uuid
-        user_uuid = d.get('user_uuid', '')
-        device['user_uuid'] = user_uuid
-        device['last_config_send_time'] = 'Never' # in case no IoT device
-        device['last_error_message'] = 'No IoT registration'
-        device['user_name'] = 'None'
-        if 0 != len(user_uuid):
-            user = get_one_from_DS(DS_users_KIND, 'user_uuid', user_uuid)
-            if user is not None:
-                device['user_name'] = user.get('username','None')
-
-        device['remote_URL'] = ''
-        device['access_point'] = ''
-        if 0 < len(device_uuid):
-            dd = get_device_data(DS_boot_KEY, device_uuid, count=1)
-            if 0 < len(dd):
-                boot = dd[0]
-
-                # get latest boot message
-                last_boot = boot.get('value')
-
-                # convert binary into string and then a dict
-                boot_dict = json.loads(utils.bytes_to_string(last_boot))
-
-                # the serveo link needs to be lower case
-                remote_URL = boot_dict.get('remote_URL')
-                if remote_URL is not None:
-                    remote_URL = remote_URL.lower()
-                    device['remote_URL'] = remote_URL
-
-                # get the AP
-                access_point = boot_dict.get('access_point')
-                if access_point is not None:
-                    # extract just the wifi code
-                    if access_point.startswith('BeagleBone-'):
-                        ap = access_point.split('-')
-                        if 2 <= len(ap):
-                            access_point = ap[1]
-                            device['access_point'] = access_point
-
-        res['devices'].append(device)
-
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    users = __get_users_by_uuid()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        res['devices'] = list(executor.map(
+                lambda d: __get_device_details(d, users), devices))
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
 #------------------------------------------------------------------------------
+# Private helper for the function below, returns the data of one device.
+def __get_device_data_details(d, users: Dict) -> Dict:
+    device = {}
+
+    device_uuid = d.get('device_uuid', '')
+    device['device_uuid'] = device_uuid
+
+    device['device_name'] = d.get('device_name', '')
+
+    user_uuid = d.get('user_uuid', '')
+    device['user_name'] = user_uuid
+    if 0 != len(user_uuid):
+        user = users.get(user_uuid)
+        if user is not None:
+            device['user_name'] = user.get('username','None')
+            device['email_address'] = user.get('email_address','None')
+
+    # Get the latest boot and sensor DeviceData for this device ID, 
+    # all in one batch.
+    sensor_keys = [DS_rh_KEY, DS_temp_KEY, DS_co2_KEY, DS_h20_ec_KEY,
+            DS_h20_ph_KEY, DS_h20_temp_KEY]
+    latest = {}
+    if 0 < len(device_uuid):
+        latest = __get_latest_device_data_rows([DS_boot_KEY] + sensor_keys,
+                device_uuid)
+    
+    device['remote_URL'] = ''
+    device['access_point'] = ''
+    if DS_boot_KEY in latest:
+        __add_boot_info_to_dict(latest[DS_boot_KEY], device)
+
+    epoch = '1970-01-01T00:00:00Z'
+    last_message_time = epoch
+
+    for key in sensor_keys:
+        if key not in latest:
+            continue
+        dd = latest[key]
+        val = dd.get('value')
+        ts = dd.get('timestamp', b'') 
+        device[key] = val
+        if ts > last_message_time:
+            last_message_time = ts
+
+    if last_message_time == epoch:
+        last_message_time = 'Never'
+    device['last_message_time'] = last_message_time 
+
+    device['stale'] = get_minutes_since_UTC_timestamp(last_message_time)
+
+    device['last_image'] = get_latest_image_URL(device_uuid)
+
+    return device
+
+
+#------------------------------------------------------------------------------
+# Each device needs its own queries, so do the devices in parallel.
 def get_list_of_device_data_from_DS():
     res = {}
     DS = get_client()
     if DS is None:
         return res
-    res['devices'] = [] # list of devices with data from each
     query = DS.query(kind=DS_devices_KIND)
     devices = list(query.fetch()) # get all devices 
-    for d in devices:
-        device = {}
-
-        device_uuid = d.get('device_uuid', '')
-        device['device_uuid'] = device_uuid
-
-        device['device_name'] = d.get('device_name', '')
-
-        user_uuid = d.get('user_uuid', '')
-        device['user_name'] = user_uuid
-        if 0 != len(user_uuid):
-            user = get_one_from_DS(DS_users_KIND, 'user_uuid', user_uuid)
-            if user is not None:
-                device['user_name'] = user.get('username','None')
-                device['email_address'] = user.get('email_address','None')
-
-        # Get the boot DeviceData for this device ID
-        dd = []
-        if 0 < len(device_uuid):
-            dd = get_device_data(DS_boot_KEY, device_uuid, count=1)
-        
-        device['remote_URL'] = ''
-        device['access_point'] = ''
-        if 0 < len(dd):
-            boot = dd[0]
-
-            # get latest boot message
-            last_boot = boot.get('value')
-
-            # convert binary into string and then a dict
-            boot_dict = json.loads(utils.bytes_to_string(last_boot))
-
-            # the serveo link needs to be lower case
-            remote_URL = boot_dict.get('remote_URL')
-            if remote_URL is not None:
-                remote_URL = remote_URL.lower()
-                device['remote_URL'] = remote_URL
-
-            # get the AP
-            access_point = boot_dict.get('access_point')
-            if access_point is not None:
-                # extract just the wifi code
-                if access_point.startswith('BeagleBone-'):
-                    ap = access_point.split('-')
-                    if 2 <= len(ap):
-                        access_point = ap[1]
-                        device['access_point'] = access_point
-
-        epoch = '1970-01-01T00:00:00Z'
-        last_message_time = epoch
-
-        # Get the boot DeviceData for this device ID
-        dd = get_device_data(DS_rh_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_rh_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        dd = get_device_data(DS_temp_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_temp_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        dd = get_device_data(DS_co2_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_co2_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        dd = get_device_data(DS_h20_ec_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_h20_ec_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        dd = get_device_data(DS_h20_ph_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_h20_ph_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        dd = get_device_data(DS_h20_temp_KEY, device_uuid, count=1)
-        if 0 < len(dd):
-            dd = dd[0]
-            val = dd.get('value')
-            ts = dd.get('timestamp', b'') 
-            device[DS_h20_temp_KEY] = val
-            if ts > last_message_time:
-                last_message_time = ts
-
-        if last_message_time == epoch:
-            last_message_time = 'Never'
-        device['last_message_time'] = last_message_time 
-
-        device['stale'] = get_minutes_since_UTC_timestamp(last_message_time)
-
-        device['last_image'] = get_latest_image_URL(device_uuid)
-
-        res['devices'].append(device)
-
-    res['timestamp'] = dt.datetime.utcnow().strftime('%FT%XZ')
+    users = __get_users_by_uuid()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        res['devices'] = list(executor.map(
+                lambda d: __get_device_data_details(d, users), devices))
+    res['timestamp'] = utils.utc_timestamp()
     return res
 
 
@@ -635,16 +785,19 @@ def get_latest_image_URL(device_uuid):
     if DS is None:
         return URL
 
+    # Saved by saveImageURL(), so we can just get it by key.
+    image_entity = DS.get(DS.key(DS_latest_image_KIND, device_uuid))
+    if image_entity:
+        return decode_url(image_entity)
+
+    # Devices that have not sent an image since we started saving the
+    # LatestImage, query for their newest image.
     # Sort by date descending
     image_query = DS.query(kind=DS_images_KIND,
                            order=['-creation_date'])
     image_query.add_filter('device_uuid', '=', device_uuid)
 
-    image_list = list(image_query.fetch(1))[::-1]
-    if not image_list:
-        return URL
-
-    image_entity = image_list[0]
+    image_entity = next(iter(image_query.fetch(1)), None)
     if not image_entity:
         return URL
     URL = decode_url(image_entity)
@@ -664,7 +817,7 @@ def get_minutes_since_UTC_timestamp(ts):
     if ts == 'Never':
         return ts
     now = dt.datetime.utcnow()
-    ts = dt.datetime.strptime(ts, '%Y-%m-%dT%H:%M:%SZ') # string to dt obj
+    ts = utils.utc_timestamp_to_datetime(ts) # string to dt obj
     delta = now - ts
     minutes = delta.total_seconds() / 60.0
     return "{}".format(int(minutes))
@@ -678,17 +831,16 @@ def get_latest_user_session_created_date_from_DS(user_uuid):
     sessions = get_all_from_DS(DS_user_session_KIND, 'user_uuid', user_uuid)
     if sessions is None or 0 == len(sessions):
         return None
-    dates = []
-    for s in sessions:
-        dates.append(s.get('created_date', '').strftime('%FT%XZ'))
-    dates.sort(reverse=True) # sort descending, newest date on top
+    dates = [utils.datetime_to_utc_timestamp(s.get('created_date', '')) 
+            for s in sessions]
+    latest = max(dates)
 
     # delete all the old (stale) sessions that are not the latest
-    for s in sessions:
-        if dates[0] != s.get('created_date', '').strftime('%FT%XZ'):
-            DS.delete(key=s.key)
+    stale_keys = [s.key for s, d in zip(sessions, dates) if d != latest]
+    for i in range(0, len(stale_keys), 500): # at most 500 keys per call
+        DS.delete_multi(stale_keys[i:i + 500])
 
-    return dates[0] # return the latest date (top of array)
+    return latest # return the latest date
 
 
 #------------------------------------------------------------------------------
@@ -756,6 +908,7 @@ def delete_device_from_DS(device_uuid):
     device = get_one_from_DS(DS_devices_KIND, 'device_uuid', device_uuid)
     if device is not None:
         DS.delete(key=device.key)
+    __devices_cache.pop(device_uuid)
 
     # We should iterate through all DeviceData_<property>_<device_id> 
     # entities and delete them, but there is no easy way to do that in 
@@ -794,12 +947,41 @@ def add_device_to_DS(device_name, device_notes):
     return None
 
 
+#------------------------------------------------------------------------------
+# Private helper that returns the entities to put to save a dict of data:
+# the timestamp keyed row, and when it is the newest data, the Latest entity
+# for this sharded kind (so readers can get the newest data by key instead
+# of with a query).  The Latest is a blind write (no read), so there is no
+# contention to worry about.
+def __make_entities_to_save(DS, kind: str, pydict: Dict, timestamp: str,
+        is_latest: bool) -> List:
+    # These entities are custom keyed with the timestamp.
+    ddkey = DS.key(kind, timestamp)
+    dd = datastore.Entity(ddkey)
+    dd.update({})   # empty entity
+    dd[DS_DeviceData_data_Property] = pydict 
+    dd[DS_DeviceData_timestamp_Property] = timestamp 
+    entities = [dd]
+    if is_latest:
+        latest = datastore.Entity(DS.key(DS_latest_KIND, kind))
+        latest[DS_DeviceData_data_Property] = pydict 
+        latest[DS_DeviceData_timestamp_Property] = timestamp 
+        entities.append(latest)
+    return entities
+
+
 #------------------------------------------------------------------------------
 # Save a dict of data to the entity by key (device id) and property.
 # A cache for UI display / charting.
 def save_dict_to_entity(entity_kind: str, entity_key: str, property_name: str, 
         pydict: Dict, timestamp: str = None) -> bool:
     try:
+        # Only the kinds that are read as the newest value need a Latest 
+        # entity.  Data saved as of now is the latest, a caller passing in
+        # a timestamp may be back filling, so its row only replaces an older
+        # Latest entity.
+        keeps_latest = __keeps_latest(entity_kind, property_name)
+        is_latest = timestamp is None and keeps_latest
         if timestamp is None:
             timestamp = dt.datetime.utcnow().isoformat()
 
@@ -808,15 +990,14 @@ def save_dict_to_entity(entity_kind: str, entity_key: str, property_name: str,
             return False
 
         kind = get_sharded_kind(entity_kind, property_name, entity_key)
-
-        # Get this entity from the datastore (or create an empty one).
-        # These entities are custom keyed with the timestamp.
-        ddkey = DS.key(kind, timestamp)
-        dd = datastore.Entity(ddkey)
-        dd.update({})   # empty entity
-        dd[DS_DeviceData_data_Property] = pydict 
-        dd[DS_DeviceData_timestamp_Property] = timestamp 
-        DS.put(dd)      # write to DS
+        entities = __make_entities_to_save(DS, kind, pydict, timestamp, 
+                is_latest)
+        if keeps_latest and not is_latest:
+            __put_latest_if_newer(entities[0], create=False, put_row=True)
+        else:
+            DS.put_multi(entities) # write to DS, in one call
+        if is_latest:
+            __latest_cache.set(kind, dict(pydict)) # write through (a copy)
         logging.info(f'ds save: entity={kind} data={pydict}')
         return True
 
@@ -827,6 +1008,43 @@ def save_dict_to_entity(entity_kind: str, entity_key: str, property_name: str,
         return False
 
 
+#------------------------------------------------------------------------------
+# Replace the device data entity with old_key (None if there isn't one) by a
+# new entity holding pydict, in one transaction.  The old entity is read 
+# again inside the transaction, so if another caller replaces or deletes it
+# first, one of the two commits fails instead of both adding a new entity.
+# Returns False (and writes nothing) if the old entity is already gone.
+# Errors from the put or the commit are raised to the caller.
+def replace_device_data(device_ID: str, property_name: str, old_key,
+        pydict: Dict) -> bool:
+    DS = get_client()
+    kind = get_device_data_kind(property_name, device_ID)
+    timestamp = dt.datetime.utcnow().isoformat()
+    is_latest = __keeps_latest(DS_device_data_KIND, property_name)
+    with DS.transaction():
+        if old_key is not None:
+            if DS.get(old_key) is None: # (read in the transaction)
+                return False
+            DS.delete(old_key)
+        DS.put_multi(__make_entities_to_save(DS, kind, pydict, timestamp, 
+                is_latest))
+    if is_latest:
+        __latest_cache.set(kind, dict(pydict)) # write through (a copy)
+    logging.info(f'ds replace: entity={kind} data={pydict}')
+    return True
+
+
+#------------------------------------------------------------------------------
+# Put back a sharded data entity (from get_sharded_entities()) that the caller
+# changed.  If it is the newest row of its kind, its Latest entity is updated
+# too (in the same transaction), so readers of get_latest_device_data() see 
+# the change.
+def put_sharded_entity(entity) -> None:
+    if get_client() is None:
+        return
+    __put_latest_if_newer(entity, create=False, put_row=True)
+
+
 #------------------------------------------------------------------------------
 # Save a dict of the recent values of each env. var. to the Device
 # that produced them - for UI display / charting.
@@ -844,7 +1062,7 @@ def saveImageURL(deviceId, publicURL, cameraName):
         return 
     key = DS.key(DS_images_KIND)
     image = datastore.Entity(key, exclude_from_indexes=[])
-    cd = time.strftime( '%FT%XZ', time.gmtime())
+    cd = utils.utc_timestamp()
     # Don't use a dict, the strings will be assumed to be "blob" and will be
     # shown as base64 in the console.
     # Use the Entity like a dict to get proper strings.
@@ -852,7 +1070,12 @@ def saveImageURL(deviceId, publicURL, cameraName):
     image['URL'] = publicURL
     image['camera_name'] = cameraName
     image['creation_date'] = cd
-    DS.put(image)  
+    # Also overwrite this device's LatestImage, so the UI can get the newest
+    # URL by key (no query).  Both are written in one call.
+    latest = datastore.Entity(DS.key(DS_latest_image_KIND, deviceId),
+            exclude_from_indexes=[])
+    latest.update(image)
+    DS.put_multi([image, latest])
     logging.info("datastore.saveImageURL: saved {}".format( image ))
     return 
 
@@ -862,11 +1085,9 @@ def get_device_name(device_uuid):
     DS = get_client()
     if DS is None:
         return 
-    query = DS.query(kind='Devices')
-    query.add_filter('device_uuid', '=', device_uuid)
-    results = list(query.fetch())
-    if len(results) > 0:
-        return results[0]["device_name"]
+    device = __get_device_entity(device_uuid)
+    if device is not None:
+        return device["device_name"]
     else:
         return "Invalid device"
 
@@ -876,12 +1097,10 @@ def get_device_software_version(device_uuid):
     DS = get_client()
     if DS is None:
         return 
-    query = DS.query(kind='Devices')
-    query.add_filter('device_uuid', '=', device_uuid)
-    results = list(query.fetch())
-    if len(results) == 0:
+    device = __get_device_entity(device_uuid)
+    if device is None:
         return None
-    return results[0].get("device_software_version", None)
+    return device.get("device_software_version", None)
 
 
 
@@ -3,10 +3,11 @@
 import json
 import base64
 import time
-import datetime as dt
+import threading
 from google.oauth2 import service_account
 from googleapiclient import discovery, errors
 
+from cloud_common.cc import utils
 from cloud_common.cc.google import env_vars
 from cloud_common.cc.google.firebase import fs_client
 
@@ -49,48 +50,133 @@ def get_IoT_client(path_to_service_account_json):
     )
 
 
-# Get an IoT client using the GCP project (NOT firebase proj!)
-iot_client = get_IoT_client(env_vars.path_to_google_service_account)
+# Global, created on first use (building it downloads the discovery doc, so
+# don't slow down every process that just imports this module).
+__iot_client = None
+__iot_devices = None
+__iot_client_lock = threading.Lock()
+
+
+# Get the IoT client using the GCP project (NOT firebase proj!)
+def get_iot_client():
+    global __iot_client
+    if __iot_client is None:
+        with __iot_client_lock:
+            if __iot_client is None:  # another thread may have created it
+                __iot_client = get_IoT_client(
+                    env_vars.path_to_google_service_account
+                )
+    return __iot_client
+
+
+# For code that still uses the iot_client module attribute (it used to be
+# created at import), forwards everything to get_iot_client() so the client
+# is still only built on first use.
+class __LazyIoTClient:
+    def __getattr__(self, name):
+        return getattr(get_iot_client(), name)
+
+iot_client = __LazyIoTClient()
+
+
+# Get the devices resource of the IoT client, it is the same for every call
+# so we only walk the projects / locations / registries chain once.
+def get_iot_devices():
+    global __iot_devices
+    if __iot_devices is None:
+        __iot_devices = (
+            get_iot_client().projects().locations().registries().devices()
+        )
+    return __iot_devices
+
+
+# path to the device registry
+registry_name = "projects/{}/locations/{}/registries/{}".format(
+    env_vars.cloud_project_id, env_vars.cloud_region, env_vars.device_registry
+)
+
+
+# The config version of the last update we sent to each device (device_id:
+# version), so the next update doesn't have to look it up.
+__config_versions = utils.TTLCache(maxsize=10000, ttl=300)
+
+
+# How many times the API client retries a read, with exponential backoff, 
+# on a 429 or 5xx response.
+# Commands and config changes are not retried, so a device never gets one 
+# twice.  Deletes are not retried either, a retry after a lost response 
+# would get a 404 for the device it just deleted and report a failure.
+__num_retries = 3
+
+
+# Returns the path to a device in the registry.
+def get_device_path(device_id):
+    return "{}/devices/{}".format(registry_name, device_id)
 
 
+# ------------------------------------------------------------------------------
+# Private helper to list all the devices in the registry, following the
+# page tokens.  field_mask is an optional comma separated list of the extra
+# Device fields to return (id and numId are always returned).
+# Returns a list of device dicts.
+def __list_devices(devices, registry_name, field_mask=None):
+    list_of_devices = []
+    kwargs = {"parent": registry_name, "pageSize": 1000}
+    if field_mask is not None:
+        kwargs["fieldMask"] = field_mask
+    while True:
+        response = devices.list(**kwargs).execute(num_retries=__num_retries)
+        list_of_devices += response.get("devices", [])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return list_of_devices
+        kwargs["pageToken"] = page_token
+
 # ------------------------------------------------------------------------------
 # Get the count of IoT registrations.
 def get_iot_registrations():
 
-    # path to the device registry
-    registry_name = "projects/{}/locations/{}/registries/{}".format(
-        env_vars.cloud_project_id, env_vars.cloud_region, env_vars.device_registry
-    )
-
     try:
         # get devices registry and list
-        devices = iot_client.projects().locations().registries().devices()
-        list_of_devices = devices.list(parent=registry_name).execute().get(
-            "devices", []
-        )
+        devices = get_iot_devices()
+        list_of_devices = __list_devices(devices, registry_name)
     except errors.HttpError as e:
         print("get_iot_registrations: ERROR: " "HttpError: {}".format(e._get_reason()))
         return False
 
     res = {}
     res["registered"] = "{:,}".format(len(list_of_devices))
-    res["timestamp"] = dt.datetime.utcnow().strftime("%FT%XZ")
+    res["timestamp"] = utils.utc_timestamp()
     return res
 
 
+# The (our key, IoT Device key, default) of the Device fields and the
+# (key, default) of the metadata fields that get_iot_device_list() returns.
+__device_fields = (
+    ("last_heartbeat_time", "lastHeartbeatTime", ""),
+    ("last_error_time", "lastErrorTime", ""),
+    ("last_config_send_time", "lastConfigSendTime", "Never"),  # last recipe
+)
+__device_metadata_fields = (
+    ("user_uuid", None),
+    ("device_notes", ""),
+    ("device_name", ""),
+)
+
+
 # Return a dict with a list of IoT devices with heartbeat and metadata.
 def get_iot_device_list():
 
-    # path to the device registry
-    registry_name = "projects/{}/locations/{}/registries/{}".format(
-        env_vars.cloud_project_id, env_vars.cloud_region, env_vars.device_registry
-    )
-
     try:
         # get devices registry and list
-        devices = iot_client.projects().locations().registries().devices()
-        list_of_devices = devices.list(parent=registry_name).execute().get(
-            "devices", []
+        devices = get_iot_devices()
+        # The list returns the fields we need, so we don't have to get
+        # each device.
+        list_of_devices = __list_devices(
+            devices,
+            registry_name,
+            field_mask="lastHeartbeatTime,lastConfigSendTime,lastErrorTime,"
+            "lastErrorStatus,metadata",
         )
     except errors.HttpError as e:
         print("get_iot_device_list: ERROR: " "HttpError: {}".format(e._get_reason()))
@@ -98,47 +184,31 @@ def get_iot_device_list():
 
     res = {}
     res["devices"] = []  # list of devices
-    for d in list_of_devices:
-        device_id = d.get("id")
-        device_name = "{}/devices/{}".format(registry_name, device_id)
-        device = devices.get(name=device_name).execute()
-        last_heartbeat_time = device.get("lastHeartbeatTime", "")
-        last_config_send_time = device.get("lastConfigSendTime", "Never")
-        last_error_time = device.get("lastErrorTime", "")
-        last_error_message = device.get("lastErrorStatus", {})
-        last_error_message = last_error_message.get("message", "")
+    for device in list_of_devices:
         metadata = device.get("metadata", {})
-        user_uuid = metadata.get("user_uuid", None)
-        device_notes = metadata.get("device_notes", "")
-        device_name = metadata.get("device_name", "")
-
-        dev = {}
-        dev["device_uuid"] = device_id  # MUST use key 'device_uuid' to match DS
-        dev["last_heartbeat_time"] = last_heartbeat_time
-        dev["last_error_time"] = last_error_time
-        dev["last_error_message"] = last_error_message
-        dev["last_config_send_time"] = last_config_send_time  # last recipe sent
-        dev["user_uuid"] = user_uuid
-        dev["device_notes"] = device_notes
-        dev["device_name"] = device_name
-
+        # MUST use key 'device_uuid' to match DS
+        dev = {"device_uuid": device.get("id")}
+        for key, iot_key, default in __device_fields:
+            dev[key] = device.get(iot_key, default)
+        dev["last_error_message"] = device.get("lastErrorStatus", {}).get(
+            "message", ""
+        )
+        for key, default in __device_metadata_fields:
+            dev[key] = metadata.get(key, default)
         res["devices"].append(dev)
 
-    res["timestamp"] = dt.datetime.utcnow().strftime("%FT%XZ")
+    res["timestamp"] = utils.utc_timestamp()
     return res
 
 # Delete a device, returns result from google API.
 def delete_iot_device(device_id):
 
-    # path to the device registry & device
-    registry_name = "projects/{}/locations/{}/registries/{}".format(
-        env_vars.cloud_project_id, env_vars.cloud_region, env_vars.device_registry
-    )
-    device_name = "{}/devices/{}".format(registry_name, device_id)
+    # path to the device
+    device_name = get_device_path(device_id)
 
     try:
         # get devices registry
-        devices = iot_client.projects().locations().registries().devices()
+        devices = get_iot_devices()
         devices.delete(name=device_name).execute()
         return True
     except errors.HttpError as e:
@@ -146,25 +216,27 @@ def delete_iot_device(device_id):
     return False
 
 
-def send_recipe_to_device_via_IoT(device_id, commands_list):
-    # get the latest config version number (int) for this device
-    device_path = "projects/{}/locations/{}/registries/{}/devices/{}".format(
-        env_vars.cloud_project_id,
-        env_vars.cloud_region,
-        env_vars.device_registry,
-        device_id,
-    )
-    devices = iot_client.projects().locations().registries().devices()
-    configs = devices.configVersions().list(name=device_path).execute().get(
-        "deviceConfigs", []
+# ------------------------------------------------------------------------------
+# Private helper to get the latest config version number (int) of a device.
+def __get_latest_config_version(devices, device_path):
+    configs = (
+        devices.configVersions()
+        .list(name=device_path)
+        .execute(num_retries=__num_retries)
+        .get("deviceConfigs", [])
     )
-
     latestVersion = 1  # the first / default version
     if 0 < len(configs):
         latestVersion = configs[0].get("version")
         # print('send_recipe_to_device_via_IoT: Current config version: {}' \
         #    'Received on: {}\n'.format( latestVersion,
         #        configs[0].get('cloudUpdateTime')))
+    return latestVersion
+
+
+def send_recipe_to_device_via_IoT(device_id, commands_list):
+    device_path = get_device_path(device_id)
+    devices = get_iot_devices()
 
     # JSON commands array we send to the device
     # {
@@ -184,32 +256,45 @@ def send_recipe_to_device_via_IoT(device_id, commands_list):
     #    ]
     # }
 
-    # can only update the LATEST version!  (so get it first)
-    version = latestVersion
-
     # send a config message to a device
-    config = {}  # a python dict
-    config["lastConfigVersion"] = str(version)
-    config["messageId"] = str(int(time.time()))  # epoch seconds as message ID
-    config["deviceId"] = str(device_id)
-    config["commands"] = commands_list
-
-    config_json = json.dumps(config)  # dict to JSON string
-    print(
-        "send_recipe_to_device_via_IoT: Sending commands to device: {}".format(
-            config_json
+    def modify_config(version):
+        config = {}  # a python dict
+        config["lastConfigVersion"] = str(version)
+        config["messageId"] = str(int(time.time()))  # epoch seconds as message ID
+        config["deviceId"] = str(device_id)
+        config["commands"] = commands_list
+
+        config_json = json.dumps(config)  # dict to JSON string
+        print(
+            "send_recipe_to_device_via_IoT: Sending commands to device: {}".format(
+                config_json
+            )
         )
-    )
 
-    config_body = {
-        "versionToUpdate": version,
-        "binaryData": base64.urlsafe_b64encode(config_json.encode("utf-8")).decode(
-            "ascii"
-        ),
-    }
-    res = iot_client.projects().locations().registries().devices().modifyCloudToDeviceConfig(
-        name=device_path, body=config_body
-    ).execute()
+        config_body = {
+            "versionToUpdate": version,
+            "binaryData": base64.urlsafe_b64encode(
+                config_json.encode("utf-8")
+            ).decode("ascii"),
+        }
+        return devices.modifyCloudToDeviceConfig(
+            name=device_path, body=config_body
+        ).execute()
+
+    # can only update the LATEST version!  We remember the version our last
+    # update returned, so we usually don't have to get it first.
+    version = __config_versions.get(device_id)
+    if version is None:
+        version = __get_latest_config_version(devices, device_path)
+    try:
+        res = modify_config(version)
+    except errors.HttpError as e:
+        if e.resp.status != 409:  # 409 (ABORTED) is a version mismatch
+            raise
+        # Someone else updated the config, get the latest version and retry.
+        version = __get_latest_config_version(devices, device_path)
+        res = modify_config(version)
+    __config_versions.set(device_id, res.get("version"))
     # print('config update result: {}'.format( res ))
 
 
@@ -217,12 +302,7 @@ def send_start_recipe_command(device_uuid, recipe_uuid, recipe_dict=None):
     print("Sending start recipe command to device")
 
     # Initialize device path
-    device_path = "projects/{}/locations/{}/registries/{}/devices/{}".format(
-        env_vars.cloud_project_id,
-        env_vars.cloud_region,
-        env_vars.device_registry,
-        device_uuid,
-    )
+    device_path = get_device_path(device_uuid)
 
     # Initialize command
     command = {"recipe_uuid": recipe_uuid}
@@ -245,7 +325,7 @@ def send_start_recipe_command(device_uuid, recipe_uuid, recipe_dict=None):
 
     # Send command to device
     try:
-        iot_client.projects().locations().registries().devices().sendCommandToDevice(
+        get_iot_devices().sendCommandToDevice(
             name=device_path, body=command_body
         ).execute()
     except errors.HttpError as e:
@@ -254,6 +334,7 @@ def send_start_recipe_command(device_uuid, recipe_uuid, recipe_dict=None):
         message = error.get("message")
         raise SendCommandError(message)
 
+
 # Create an entry in the Google IoT device registry.
 # This is part of the device registration process that allows it to communicate
 # with the backend.
@@ -275,18 +356,17 @@ def create_iot_device_registry_entry(
     #    state = keyd['state']
     #    print('key={}, cksum={}, state={}'.format(key,cksum,state))
 
-    # query the collection for the users code
-    query = keys_ref.where(u"cksum", u"==", verification_code)
-    docs = list(query.get())
-    if not docs:
+    # query the collection for the users code (we only use the first match)
+    query = keys_ref.where(u"cksum", u"==", verification_code).limit(1)
+    doc = next(iter(query.stream()), None)
+    if doc is None:
         print(
             "create_iot_device_registry_entry: ERROR: "
             'Verification code "{}" not found.'.format(verification_code)
         )
         raise ValueError('Verification code "{}" not found.'.format(verification_code))
 
-    # get the single matching doc
-    doc = docs[0]
+    # the single matching doc
     key_dict = doc.to_dict()
     doc_id = doc.id
 
@@ -329,14 +409,9 @@ def create_iot_device_registry_entry(
         },
     }
 
-    # path to the device registry
-    registry_name = "projects/{}/locations/{}/registries/{}".format(
-        env_vars.cloud_project_id, env_vars.cloud_region, env_vars.device_registry
-    )
-
     try:
         # add the device to the IoT registry
-        devices = iot_client.projects().locations().registries().devices()
+        devices = get_iot_devices()
         devices.create(parent=registry_name, body=device_template).execute()
     except errors.HttpError as e:
         print(
@@ -352,7 +427,8 @@ def create_iot_device_registry_entry(
         )
     )
 
-    # mark device state as verified
+    # mark device state as verified, before we return, so the code can't
+    # be used again
     # (can only call update on a DocumentReference)
     doc_ref = doc.reference
     doc_ref.update({u"state": u"verified"})
@@ -1,9 +1,10 @@
 # https://google-cloud-python.readthedocs.io/en/stable/storage/client.html
 
-import logging, time, tempfile
+import logging, tempfile
 from datetime import datetime, timezone
 from google.cloud import storage
 
+from cloud_common.cc import utils
 from cloud_common.cc.google import env_vars
 
 # Storage client for Google Cloud
@@ -138,7 +139,7 @@ def saveFile(varName, imageType, imageBytes, deviceId ):
 
     bucket = storage_client.get_bucket(env_vars.cs_bucket)
     filename = '{}_{}_{}.{}'.format( deviceId, varName,
-        time.strftime( '%FT%XZ', time.gmtime() ), imageType )
+        utils.utc_timestamp(), imageType )
     blob = bucket.blob( filename ) # make a new blob
 
     content_type = 'image/{}'.format( imageType )
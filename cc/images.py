@@ -3,14 +3,19 @@
 import os, logging
 from PIL import Image
 
+# The input and output can be file names, or file objects (such as an 
+# io.BytesIO) to resize an image in memory.
 def resize(input_file, output_file, size=None) -> None:
     try:
         img = Image.open(input_file)
+        # A file object has no extension to get the output format from, 
+        # so write the same format we read.
+        img_format = None if isinstance(output_file, str) else img.format
         if size is None:
             # halves each dimension 
             size = int(img.size[0] / 2), int(img.size[1] / 2)
-        img.thumbnail(size, Image.ANTIALIAS)
-        img.save(output_file)  #, "PNG")
+        # (thumbnail() already lets the JPEG decoder scale down with draft())
+        img.thumbnail(size, Image.LANCZOS) # the same filter as ANTIALIAS
+        img.save(output_file, img_format)  #, "PNG")
     except Exception as e:
         logging.error(f'images.resize {e}')
-        
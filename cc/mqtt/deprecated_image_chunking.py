@@ -9,7 +9,7 @@
       are all upgraded to the latest v5 brain.  Hopefully in Fall 2019.
 """
 
-import sys, logging, ast, time, traceback, base64
+import sys, logging, ast, traceback, base64
 from datetime import datetime
 
 from typing import Dict
@@ -303,7 +303,7 @@ class DeprecatedImageChunking:
         ID = idKey + '~{}~{}~' + deviceId
 
         row = (ID.format(varName, 
-            time.strftime('%FT%XZ', time.gmtime())), # id column
+            utils.utc_timestamp()), # id column
             values, 0, 0) # values column, with zero for X, Y
 
         rowsList.append(row)
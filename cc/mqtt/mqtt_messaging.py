@@ -4,7 +4,7 @@
     - Handles messages published by our devices.
 """
 
-import os, sys, logging, ast, time, tempfile
+import os, sys, logging, ast, time, io
 from datetime import datetime
 
 from typing import Dict
@@ -45,6 +45,20 @@ class MQTTMessaging:
     recipeAction_KEY = 'action'
     recipeName_KEY = 'name'
 
+    # all the valid message types
+    messageTypes = frozenset((messageType_EnvVar, messageType_CommandReply, 
+        messageType_Image, messageType_ImageUpload, messageType_RecipeEvent))
+
+    # mandatory keys for each message type
+    # (the recipe name is not checked, a stop or end event doesn't need it)
+    mandatoryKeys = {
+        messageType_EnvVar: frozenset((var_KEY, values_KEY)),
+        messageType_CommandReply: frozenset((var_KEY, values_KEY)),
+        messageType_Image: frozenset((varName_KEY, imageType_KEY)),
+        messageType_ImageUpload: frozenset((varName_KEY, fileName_KEY)),
+        messageType_RecipeEvent: frozenset((recipeAction_KEY,)),
+    }
+
     # keys for datastore entities
     DS_device_data_KEY = 'DeviceData'
     DS_env_vars_MAX_size = 100 # maximum number of values in each env. var list
@@ -67,7 +81,10 @@ class MQTTMessaging:
             logging.error(f'{self.name}.parse: invalid message={message}')
             return 
 
-        if self.messageType_Image == self.get_message_type(message):
+        # Validated above, so this is one of our messageTypes.
+        message_type = message[self.messageType_KEY]
+
+        if self.messageType_Image == message_type:
             #logging.warning(f'{self.name}.parse: ignoring old chunked images '
             #        'from old clients.')
             deprecated = DeprecatedImageChunking()
@@ -75,42 +92,42 @@ class MQTTMessaging:
             return 
 
         # New way of handling (already) uploaded images.  
-        if self.messageType_ImageUpload == self.get_message_type(message):
-            self.save_uploaded_image(message, device_ID)
+        if self.messageType_ImageUpload == message_type:
+            self.save_uploaded_image(message, device_ID, message_type)
             return
 
         # Device sent a recipe event (start or stop) and we must 
         # republish a notification message to the notifications topic
         # using our NotificationMessaging class.
-        if self.messageType_RecipeEvent == self.get_message_type(message):
+        if self.messageType_RecipeEvent == message_type:
             action = message.get(self.recipeAction_KEY)
-            message_type = None
+            notification_type = None
             name = message.get(self.recipeName_KEY)
             if action == 'start':
-                message_type = NotificationMessaging.recipe_start
+                notification_type = NotificationMessaging.recipe_start
                 self.runs.start(device_ID,name)
             elif action == 'stop':
-                message_type = NotificationMessaging.recipe_stop
+                notification_type = NotificationMessaging.recipe_stop
                 self.runs.stop(device_ID)
             elif action == 'end':
-                message_type = NotificationMessaging.recipe_end
+                notification_type = NotificationMessaging.recipe_end
                 self.runs.stop(device_ID)
-            if message_type is None:
+            if notification_type is None:
                 logging.error(f'{self.name}.parse: invalid recipe event '
                         f'action={action}')
                 return
             # TODO: Re-enable this when notifications get turned back on (After removing saving of the
             #   runs() data from the notification service.
-            # self.notification_messaging.publish(device_ID, message_type, name)
+            # self.notification_messaging.publish(device_ID, notification_type, name)
             return
 
         # Save the most recent data as properties on the Device entity in the
         # datastore.
-        self.save_data_to_Device(message, device_ID)
+        self.save_data_to_Device(message, device_ID, message_type)
 
         # Also insert into BQ (Env vars and command replies)
         rowsList = []
-        if self.makeBQRowList(message, device_ID, rowsList):
+        if self.makeBQRowList(message, device_ID, rowsList, message_type):
             bigquery.data_insert(rowsList)
 
 
@@ -118,34 +135,12 @@ class MQTTMessaging:
     # Validate the pubsub message we received.
     # Returns True for valid, False otherwise.
     def validate_message(self, message: Dict[str, str]) -> bool:
-        if not utils.key_in_dict(message, self.messageType_KEY):
-            return False
-        message_type = self.get_message_type(message)
-        if not (message_type == self.messageType_EnvVar or \
-                message_type == self.messageType_CommandReply or \
-                message_type == self.messageType_Image or \
-                message_type == self.messageType_ImageUpload or \
-                message_type == self.messageType_RecipeEvent):
+        message_type = message.get(self.messageType_KEY)
+        if not isinstance(message_type, str) or \
+                message_type not in self.messageTypes:
             return False
-        if message_type == self.messageType_EnvVar or \
-                message_type == self.messageType_CommandReply:
-            # mandatory keys for msg types 'EnvVar' and 'CommandReply'
-            if not (utils.key_in_dict(message, self.var_KEY) or \
-                    utils.key_in_dict(message, self.values_KEY)):
-                return False
-        if message_type == self.messageType_Image or \
-                message_type == self.messageType_ImageUpload:
-            # mandatory keys for image messages
-            if not (utils.key_in_dict(message, self.varName_KEY) or \
-                    utils.key_in_dict(message, self.imageType_KEY) or \
-                    utils.key_in_dict(message, self.fileName_KEY)):
-                return False
-        if message_type == self.messageType_RecipeEvent:
-            # mandatory keys for recipe event messages
-            if not (utils.key_in_dict(message, self.recipeAction_KEY) or \
-                    utils.key_in_dict(message, self.recipeName_KEY)):
-                return False
-        return True
+        # all the mandatory keys for this type must be in the message
+        return self.mandatoryKeys[message_type].issubset(message)
 
 
     #--------------------------------------------------------------------------
@@ -155,21 +150,9 @@ class MQTTMessaging:
             logging.error('Missing key %s' % self.messageType_KEY)
             return None
 
-        if self.messageType_EnvVar == message.get(self.messageType_KEY):
-            return self.messageType_EnvVar
-
-        if self.messageType_CommandReply == message.get(self.messageType_KEY):
-            return self.messageType_CommandReply
-
-        # deprecated
-        if self.messageType_Image == message.get(self.messageType_KEY):
-            return self.messageType_Image
-
-        if self.messageType_ImageUpload == message.get(self.messageType_KEY):
-            return self.messageType_ImageUpload
-
-        if self.messageType_RecipeEvent == message.get(self.messageType_KEY):
-            return self.messageType_RecipeEvent
+        message_type = message.get(self.messageType_KEY)
+        if message_type in self.messageTypes:
+            return message_type
 
         logging.error('get_message_type: Invalid value {} for key {}'.format(
             message.get(self.messageType_KEY), self.messageType_KEY ))
@@ -197,7 +180,7 @@ class MQTTMessaging:
         ID = idKey + '~{}~{}~' + deviceId
 
         row = (ID.format(varName, 
-            time.strftime('%FT%XZ', time.gmtime())), # id column
+            utils.utc_timestamp()), # id column
             values, 0, 0) # values column, with zero for X, Y
 
         rowsList.append(row)
@@ -205,9 +188,11 @@ class MQTTMessaging:
 
     #--------------------------------------------------------------------------
     # returns True if there are rows to insert into BQ, false otherwise.
-    def makeBQRowList(self, valueDict, deviceId, rowsList):
+    # Pass messageType if the caller already has it.
+    def makeBQRowList(self, valueDict, deviceId, rowsList, messageType=None):
 
-        messageType = self.get_message_type( valueDict )
+        if None == messageType:
+            messageType = self.get_message_type( valueDict )
         if None == messageType:
             return False
 
@@ -227,11 +212,14 @@ class MQTTMessaging:
     #--------------------------------------------------------------------------
     # Save a bounded list of the recent values of each env. var. to the Device
     # that produced them - for UI display / charting.
-    def save_data_to_Device(self, pydict, deviceId):
+    # Pass message_type if the caller already has it.
+    def save_data_to_Device(self, pydict, deviceId, message_type=None):
         try:
-            if self.messageType_EnvVar != self.get_message_type(pydict) and \
-            self.messageType_CommandReply != self.get_message_type(pydict):
-                logging.debug(f"save_data_to_Device: invalid message type {self.get_message_type(pydict)}")
+            if message_type is None:
+                message_type = self.get_message_type(pydict)
+            if self.messageType_EnvVar != message_type and \
+            self.messageType_CommandReply != message_type:
+                logging.debug(f"save_data_to_Device: invalid message type {message_type}")
                 return
 
             # each received EnvVar type message must have these fields
@@ -241,13 +229,15 @@ class MQTTMessaging:
                 return
             varName = pydict[ self.var_KEY ]
 
-            value = self.__string_to_value( pydict[ self.values_KEY ] )
-            name = self.__string_to_name( pydict[ self.values_KEY ] )
+            name, value = self.__string_to_name_and_value( 
+                    pydict[ self.values_KEY ] )
             valueToSave = { 
-                'timestamp': str( time.strftime( '%FT%XZ', time.gmtime())),
+                'timestamp': utils.utc_timestamp(),
                 'name': str( name ),
                 'value': str( value ) }
 
+            # Written before we return, so the pubsub message is only acked
+            # once the data is saved.
             datastore.save_device_data(deviceId, varName, valueToSave)
 
         except Exception as e:
@@ -255,54 +245,63 @@ class MQTTMessaging:
 
 
     #--------------------------------------------------------------------------
-    # Private method to get the value from a string of data from the device
-    # or DB.  Handles weird stuff like a string in a string.
-    def __string_to_value(self, string):
+    # Private method to get the name and value from a string of data from the
+    # device or DB.  Handles weird stuff like a string in a string.
+    # The string is only evaluated once for both (it is the most expensive 
+    # thing we do with each message).
+    # Returns a tuple of (name, value).
+    def __string_to_name_and_value(self, string):
         try:
             values = ast.literal_eval( string ) # if this works, great!
             firstVal = values['values'][0]
-            return firstVal['value']
         except:
             # If the above has issues, the string probably has an embedded string.
             # Such as this:
             # "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}"
-            valueTag = "\'value\':\'"
-            endTag = "}]}"
-            valueStart = string.find( valueTag )
-            valueEnd = string.find( endTag )
-            if -1 == valueStart or -1 == valueEnd:
-                return string
-            valueStart += len( valueTag )
-            valueEnd -= 1
-            val = string[ valueStart:valueEnd ]
-            return ast.literal_eval(val) # let exceptions from this flow up
-        return string
-
+            firstVal = None
 
-    #--------------------------------------------------------------------------
-    # Private method to get the name from a string of data from the device
-    # or DB.  Handles weird stuff like a string in a string.
-    def __string_to_name(self, string):
+        # Each field falls back to the embedded string parse on its own, so a
+        # good eval that is only missing one of them still uses the other.
         try:
-            values = ast.literal_eval( string ) # if this works, great!
-            firstVal = values['values'][0]
-            return firstVal['name']
+            value = firstVal['value']
         except:
-            # If the above has issues, the string probably has an embedded string.
-            # Such as this:
-            # "{'values':[{'name':'LEDPanel-Top', 'type':'str', 'value':'{'400-449': 0.0, '450-499': 0.0, '500-549': 83.33, '550-559': 16.67, '600-649': 0.0, '650-699': 0.0}'}]}"
-            nameTag = "\'name\':\'"
-            endTag = "\'"
-            nameStart = string.find( nameTag )
-            if -1 == nameStart:
-                return None
-            nameStart += len( nameTag )
-            nameEnd = string.find( endTag, nameStart )
-            if -1 == nameEnd:
-                return None
-            name = string[ nameStart:nameEnd ]
-            return name
-        return ''
+            value = self.__embedded_string_to_value(string)
+        try:
+            name = firstVal['name']
+        except:
+            name = self.__embedded_string_to_name(string)
+        return name, value
+
+
+    #--------------------------------------------------------------------------
+    # Private method to get the value from a string with an embedded string.
+    def __embedded_string_to_value(self, string):
+        valueTag = "\'value\':\'"
+        endTag = "}]}"
+        valueStart = string.find( valueTag )
+        valueEnd = string.find( endTag )
+        if -1 == valueStart or -1 == valueEnd:
+            return string
+        valueStart += len( valueTag )
+        valueEnd -= 1
+        val = string[ valueStart:valueEnd ]
+        return ast.literal_eval(val) # let exceptions from this flow up
+
+
+    #--------------------------------------------------------------------------
+    # Private method to get the name from a string with an embedded string.
+    def __embedded_string_to_name(self, string):
+        nameTag = "\'name\':\'"
+        endTag = "\'"
+        nameStart = string.find( nameTag )
+        if -1 == nameStart:
+            return None
+        nameStart += len( nameTag )
+        nameEnd = string.find( endTag, nameStart )
+        if -1 == nameEnd:
+            return None
+        name = string[ nameStart:nameEnd ]
+        return name
 
 
     #--------------------------------------------------------------------------
@@ -311,9 +310,12 @@ class MQTTMessaging:
     # firebase cloud function.   (in an open and un-secured manner) 
     # This is just a message telling us it was done (over the secure IoT 
     # messaging) and gives us a hook to move the image and save its URL.
-    def save_uploaded_image(self, pydict, deviceId):
+    # Pass message_type if the caller already has it.
+    def save_uploaded_image(self, pydict, deviceId, message_type=None):
         try:
-            if self.messageType_ImageUpload != self.get_message_type(pydict):
+            if message_type is None:
+                message_type = self.get_message_type(pydict)
+            if self.messageType_ImageUpload != message_type:
                 logging.error("save_uploaded_image: invalid message type")
                 return
 
@@ -367,55 +369,26 @@ class MQTTMessaging:
                 #logging.info(f'save_uploaded_image: {img_in_bucket} '
                 #        f'file {file_name} is in {env_vars.cs_bucket}')
 
-                # use named temporary files to download and resize the image
+                # download and resize the image in memory
                 f_split = os.path.splitext(file_name)
-                with tempfile.NamedTemporaryFile(suffix=f_split[1]) \
-                        as downloaded_image_fp:
-
-                    downloaded = storage.downloadFile(downloaded_image_fp, 
-                            env_vars.cs_bucket, file_name)
-                    if not downloaded:
-                        logging.error(f'save_uploaded_image: '
-                                f'image not downloaded: {file_name}')
-
-                    # save a medium sized version of the image
-                    downloaded_image_fp.seek(0) # rewind to start of stream
-                    with tempfile.NamedTemporaryFile(suffix=f_split[1]) \
-                            as smaller_image_fp:
-
-                        # halves each dimension by default
-                        images.resize(downloaded_image_fp.name, 
-                                smaller_image_fp.name)
-
-                        fn = f_split[0] + '_medium' + f_split[1]
-                        storage.uploadFile(smaller_image_fp, 
-                                env_vars.cs_bucket, fn)
-
-                    # save a small sized version of the image
-                    downloaded_image_fp.seek(0) # rewind to start of stream
-                    with tempfile.NamedTemporaryFile(suffix=f_split[1]) \
-                            as smaller_image_fp:
-
-                        images.resize(downloaded_image_fp.name, 
-                                smaller_image_fp.name,
-                                (640, 480)) # good for ani gif
-
-                        fn = f_split[0] + '_small' + f_split[1]
-                        storage.uploadFile(smaller_image_fp, 
-                                env_vars.cs_bucket, fn)
-
-                    # save a small sized version of the image
+                downloaded_image_fp = io.BytesIO()
+                downloaded = storage.downloadFile(downloaded_image_fp, 
+                        env_vars.cs_bucket, file_name)
+                if not downloaded:
+                    logging.error(f'save_uploaded_image: '
+                            f'image not downloaded: {file_name}')
+
+                # save medium (halves each dimension), small (good for 
+                # ani gif) and thumbnail sized versions of the image
+                for suffix, size in (('_medium', None), 
+                        ('_small', (640, 480)), ('_thumbnail', (128, 128))):
                     downloaded_image_fp.seek(0) # rewind to start of stream
-                    with tempfile.NamedTemporaryFile(suffix=f_split[1]) \
-                            as smaller_image_fp:
-
-                        images.resize(downloaded_image_fp.name, 
-                                smaller_image_fp.name,
-                                (128, 128)) # thumbnail size
+                    smaller_image_fp = io.BytesIO()
+                    images.resize(downloaded_image_fp, smaller_image_fp, size)
 
-                        fn = f_split[0] + '_thumbnail' + f_split[1]
-                        storage.uploadFile(smaller_image_fp, 
-                                env_vars.cs_bucket, fn)
+                    fn = f_split[0] + suffix + f_split[1]
+                    storage.uploadFile(smaller_image_fp, 
+                            env_vars.cs_bucket, fn)
 
                 # Put the URL in the datastore for the UI to use.
                 datastore.saveImageURL(deviceId, publicURL, var_name)
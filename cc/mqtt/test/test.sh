@@ -0,0 +1,43 @@
+#!/bin/bash
+
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )"/../../../.. && pwd )"
+cd $DIR # Go to the project top level dir.
+
+if [[ -z "${GOOGLE_APPLICATION_CREDENTIALS}" ]]; then
+  source $DIR/config/gcloud_env.bash
+fi
+
+if ! [ -d pyenv ]; then
+  echo 'ERROR: you have not run ./scripts/local_development_one_time_setup.sh'
+  exit 1
+fi
+
+source pyenv/bin/activate
+
+export PYTHONPATH=$DIR
+
+# Run our entry point:
+python3.6 -c '
+from cloud_common.cc.mqtt.mqtt_messaging import MQTTMessaging
+
+# (the parse does not use any instance state, so skip __init__)
+mm = MQTTMessaging.__new__(MQTTMessaging)
+parse = mm._MQTTMessaging__string_to_name_and_value
+
+# A plain string that evaluates.
+ret = parse("{\"values\":[{\"name\":\"SHT25-Top\", \"type\":\"float\", \"value\":24.0}]}")
+print(f"plain returned {ret}\n")
+assert ret == ("SHT25-Top", 24.0)
+
+# A string with an embedded string, that does not evaluate.
+ret = parse("{\"values\":[{\"name\":\"LEDPanel-Top\", \"type\":\"str\", \"value\":\"{\"400-449\": 0.0, \"450-499\": 83.33}\"}]}".replace("\"", "\x27"))
+print(f"embedded returned {ret}\n")
+assert ret == ("LEDPanel-Top", {"400-449": 0.0, "450-499": 83.33})
+
+# Evaluates but has no name: the value still comes from the eval.
+ret = parse("{\"values\":[{\"type\":\"float\", \"value\":24.0}]}")
+print(f"no name returned {ret}\n")
+assert ret == (None, 24.0)
+
+print("all passed\n")
+'
@@ -5,8 +5,7 @@
     Design: https://github.com/OpenAgricultureFoundation/notification-service/blob/master/docs/API.pdf
 """
 
-import datetime as dt
-import json, logging, pprint
+import json, logging
 
 from typing import Dict, List
 
@@ -50,19 +49,21 @@ class NotificationData:
     # Return a string of the notifications for a device.  
     # For testing and debugging.
     def to_str(self, device_ID: str) -> str:
-        pp = pprint.PrettyPrinter()
-        out = pp.pformat(self.__get_all(device_ID))
+        out = json.dumps(self.__get_all(device_ID), indent=2, default=str)
         return out
 
 
     #--------------------------------------------------------------------------
     # Add a new notification for this device, set created TS to now().
+    # A caller adding many notifications can pass the created TS in.
     # Returns the notification ID string.
     def add(self, device_ID: str, message: str, 
             notification_type: str = type_Done,
-            URL: str = None) -> str:
+            URL: str = None, created: str = None) -> str:
         notification_ID = utils.id_generator()
-        now = dt.datetime.utcnow().strftime('%FT%XZ')
+        now = created
+        if now is None:
+            now = utils.utc_timestamp()
 
         # create a new dict
         notif_dict = {}
@@ -70,7 +71,8 @@ class NotificationData:
         notif_dict[self.type_key] = notification_type
         notif_dict[self.message_key] = message
         notif_dict[self.created_key] = now
-        notif_dict[self.URL_key] = URL
+        if URL is not None: # optional, readers get() it
+            notif_dict[self.URL_key] = URL
 
         # save the dict to the datastore
         datastore.save_device_data(device_ID, self.dd_property, notif_dict)
@@ -88,17 +90,15 @@ class NotificationData:
     #--------------------------------------------------------------------------
     # Find notification by ID and delete it, to ack it.
     def ack(self, device_ID: str, notification_ID: str) -> None:
-        entities = datastore.get_sharded_entities(
+        entities = datastore.get_sharded_entities_by_data_value(
                 datastore.DS_device_data_KIND, 
-                self.dd_property, device_ID)
+                self.dd_property, device_ID, 
+                self.ID_key, notification_ID, count=1)
         for e in entities:
-            data = e.get(datastore.DS_DeviceData_data_Property, {})
-            if data.get(self.ID_key) == notification_ID:
-                # delete this entity (as a form of acknowledging it and 
-                # keeping the list of notifications from growing without 
-                # bounds).
-                DS = datastore.get_client()
-                DS.delete(key=e.key)
-                break
+            # delete this entity (as a form of acknowledging it and 
+            # keeping the list of notifications from growing without 
+            # bounds).
+            DS = datastore.get_client()
+            DS.delete(key=e.key)
 
 
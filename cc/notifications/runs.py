@@ -5,8 +5,7 @@
     Design: https://github.com/OpenAgricultureFoundation/notification-service/blob/master/docs/API.pdf
 """
 
-import datetime as dt
-import json, logging, pprint
+import json, logging
 
 from typing import Dict, List
 
@@ -47,8 +46,7 @@ class Runs:
     #--------------------------------------------------------------------------
     # Return the runs for a device.  For testing and debugging.
     def to_str(self, device_ID: str) -> str:
-        pp = pprint.PrettyPrinter()
-        out = pp.pformat(self.get_all(device_ID))
+        out = json.dumps(self.get_all(device_ID), indent=2, default=str)
         return out
 
 
@@ -81,7 +79,7 @@ class Runs:
     # Start a new run for this device.
     #   { start: now(), end: None, recipe_name: recipe_name }
     def start(self, device_ID: str, recipe_name: str) -> None:
-        run = {self.start_key:  dt.datetime.utcnow().strftime('%FT%XZ'),
+        run = {self.start_key:  utils.utc_timestamp(),
                self.end_key:    None,
                self.recipe_key: recipe_name
         }
@@ -104,12 +102,11 @@ class Runs:
         e = entities[0] # only one entity in the list
         # get this entities data property and update it
         run = e.get(datastore.DS_DeviceData_data_Property, {})
-        run[self.end_key] = dt.datetime.utcnow().strftime('%FT%XZ')
+        run[self.end_key] = utils.utc_timestamp()
 
-        # put entity back in datastore
-        DS = datastore.get_client()
-        DS.put(e)
-        logging.debug(f'{self.name}.stopped run {run}')
+        # put entity back in datastore (it is the latest run)
+        datastore.put_sharded_entity(e)
+        logging.debug('%s.stopped run %s', self.name, run)
 
 
 
@@ -6,7 +6,7 @@
 """
 
 import datetime as dt
-import json, logging, pprint
+import json, logging
 
 from typing import Dict, List, Any
 
@@ -81,8 +81,7 @@ class Scheduler:
     #--------------------------------------------------------------------------
     # Get the list of commands we support for display.
     def get_commands(self) -> str:
-        pp = pprint.PrettyPrinter()
-        out = pp.pformat(self.commands)
+        out = json.dumps(self.commands, indent=2, default=str)
         return f'{self.name} Commands:\n{out}'
 
 
@@ -105,8 +104,7 @@ class Scheduler:
     #--------------------------------------------------------------------------
     # Return a string of the schedule for a device.  For testing and debugging.
     def to_str(self, device_ID: str) -> str:
-        pp = pprint.PrettyPrinter()
-        out = pp.pformat(self.__get_schedule(device_ID))
+        out = json.dumps(self.__get_schedule(device_ID), indent=2, default=str)
         return out
 
 
@@ -118,18 +116,14 @@ class Scheduler:
             logging.error(f'{self.name}.get_command_entity '
                     f'invalid command {command}')
             return None
-        # get list of all entities by time
-        entities = datastore.get_sharded_entities(
+        # there can only be one of each command per device
+        entities = datastore.get_sharded_entities_by_data_value(
                 datastore.DS_device_data_KIND, 
-                self.schedule_property, device_ID)
+                self.schedule_property, device_ID, 
+                self.command_key, command, count=1)
         if 0 == len(entities):
             return None
-        for e in entities:
-            # get this entities data property 
-            cmd_dict = e.get(datastore.DS_DeviceData_data_Property, {})
-            if cmd_dict.get(self.command_key) == command:
-                return e
-        return None
+        return entities[0]
 
 
     #--------------------------------------------------------------------------
@@ -149,28 +143,23 @@ class Scheduler:
             return
 
         # customize the command template
-        template = self.commands.get(command, {})
-        repeat = template.get(self.default_repeat_hours_key, 0)
+        repeat = self.command_repeat_hours[command]
         if repeat_hours >= 0:
             repeat = repeat_hours
 
         # calculate when to run this command: now + repeat hours
         utc_in_repeat_hours = dt.datetime.utcnow() + dt.timedelta(hours=repeat)
-        run_at_time = utc_in_repeat_hours.strftime('%FT%XZ')
+        run_at_time = utils.datetime_to_utc_timestamp(utc_in_repeat_hours)
 
         # create a new command
-        cmd_dict = {}
-        cmd_dict[self.command_key] = command
-        cmd_dict[self.message_key] = template.get(self.message_key, '')
+        cmd_dict = self.command_dicts[command].copy()
         cmd_dict[self.run_at_key]  = run_at_time
         cmd_dict[self.repeat_key]  = repeat
-        cmd_dict[self.count_key]   = 0
-        cmd_dict[self.URL_key]     = template.get(self.URL_key, '')
 
         # update this command dict (remove and add)
         self.update_command(device_ID, cmd_dict)
 
-        logging.debug(f'{self.name}.added command to schedule: {cmd_dict}')
+        logging.debug('%s.added command to schedule: %s', self.name, cmd_dict)
 
 
     #--------------------------------------------------------------------------
@@ -180,9 +169,8 @@ class Scheduler:
             logging.error(f'{self.name}.create_notification invalid '
                     f'command {command}')
             return
-        template = self.commands.get(command, {})
-        cmd_msg = template.get(self.message_key, '')
-        URL = template.get(self.URL_key, '')
+        cmd_msg = self.command_messages[command]
+        URL = self.command_URLs[command]
         nd = NotificationData()
         nd.add(device_ID, cmd_msg, URL=URL)
 
@@ -193,10 +181,22 @@ class Scheduler:
         # get any existing entity for this command and delete it.
         entity = self.get_command_entity(device_ID, command)
         if entity is not None:
-            # delete this entity
-            DS = datastore.get_client()
+            self.remove_command_entity(entity)
+        logging.debug('%s.remove_command %s', self.name, command)
+
+
+    #--------------------------------------------------------------------------
+    # Remove a command entity we already have (from get_command_entity()).
+    # The entity is read again in the delete transaction, so if another 
+    # caller removed or replaced it first, we return False.
+    # Datastore errors (such as a failed commit) are raised.
+    def remove_command_entity(self, entity) -> bool:
+        DS = datastore.get_client()
+        with DS.transaction():
+            if DS.get(entity.key) is None: # (read in the transaction)
+                return False
             DS.delete(key=entity.key)
-        logging.debug(f'{self.name}.remove_command {command}')
+        return True
 
 
     #--------------------------------------------------------------------------
@@ -209,23 +209,41 @@ class Scheduler:
         if 0 == len(entities):
             return None
         DS = datastore.get_client()
-        for e in entities:
-            DS.delete(key=e.key)
+        keys = [e.key for e in entities]
+        for i in range(0, len(keys), 500): # at most 500 keys per call
+            DS.delete_multi(keys[i:i + 500])
         logging.debug(f'{self.name}.remove_all_commands done.')
 
 
     #--------------------------------------------------------------------------
     # Replaces a command in the entity.  
-    def update_command(self, device_ID: str, cmd_dict: Dict[str, str]) -> None:
+    # Pass the existing entity for this command if the caller has it, so we
+    # don't have to look it up again.
+    # Returns True if the command was saved, False if it is invalid or 
+    # another caller already replaced the entity.
+    # Datastore errors (such as a failed commit) are raised.
+    def update_command(self, device_ID: str, cmd_dict: Dict[str, str],
+            entity: Any = None) -> bool:
         cmd_name = cmd_dict.get(self.command_key, None)
         if not self.__validate_command(cmd_name):
             logging.error(f'{self.name}.update_command invalid {cmd_name}')
-            return
-        # get any existing entity for this command and delete it.
-        self.remove_command(device_ID, cmd_name)
-        # save the command as a new entity
-        datastore.save_device_data(device_ID, self.schedule_property, cmd_dict)
-        logging.debug(f'{self.name}.update_command {cmd_dict}')
+            return False
+        # get any existing entity for this command 
+        # (the query can't be in the transaction, it isn't an ancestor query)
+        if entity is None:
+            entity = self.get_command_entity(device_ID, cmd_name)
+        # Delete it and save the command as a new entity, in one transaction
+        # that re-reads the old entity.  So two updates of the same command
+        # can't both replace it.  (two adds of a new command can still race,
+        # there is no entity for them to conflict on)
+        old_key = None if entity is None else entity.key
+        if not datastore.replace_device_data(device_ID, 
+                self.schedule_property, old_key, cmd_dict):
+            logging.warning('%s.update_command %s was already replaced',
+                    self.name, cmd_name)
+            return False
+        logging.debug('%s.update_command %s', self.name, cmd_dict)
+        return True
 
 
     #--------------------------------------------------------------------------
@@ -238,38 +256,45 @@ class Scheduler:
     # private internal method: 
     # Execute the command:
     #   Adds notifications to a devices queue.
-    def __execute(self, device_ID: str, now: Any, cmd: Dict[str, str]) -> None:
-        logging.debug(f'{self.name}.__execute {cmd}')
+    # entity is the datastore entity that cmd is from.
+    # created is the (real) UTC timestamp for the notifications.
+    def __execute(self, device_ID: str, now: Any, cmd: Dict[str, str],
+            entity: Any, created: str) -> None:
+        logging.debug('%s.__execute %s', self.name, cmd)
 
         cmd_name = cmd.get(self.command_key)
         cmd_msg = cmd.get(self.message_key)
         URL = cmd.get(self.URL_key)
-
-        # All our existing commands just create a notification
-        nd = NotificationData()
-        nd.add(device_ID, cmd_msg, URL=URL)
+        repeat = cmd.get(self.repeat_key, 0)
 
         # For the take measurements command, the first repeat time is a week,
         # then it repeats every default (48) hours.
-        default_repeat = cmd.get(self.repeat_key)
+        default_repeat = repeat
         if cmd_name == self.take_measurements_command:
-            template = self.commands.get(cmd_name, {})
-            default_repeat = template.get(self.default_repeat_hours_key, 0)
+            default_repeat = self.command_repeat_hours[cmd_name]
 
+        # Update the schedule first.  If that fails the command is still due
+        # and runs on the next check, and if another check already ran it, 
+        # we don't notify the user twice.
         # Does this command repeat?
-        repeat = cmd.get(self.repeat_key, 0)
         if repeat == 0:
             # No, so remove the command from the schedule.
-            self.remove_command(device_ID, cmd_name)
-            logging.debug(f'{self.name}.check removed {cmd_name}')
+            if not self.remove_command_entity(entity):
+                return
+            logging.debug('%s.check removed %s', self.name, cmd_name)
         else:
             # Update the count and next run time.
             cmd[self.count_key] = cmd.get(self.count_key, 0) + 1
             run_at = now + dt.timedelta(hours=default_repeat)
-            cmd[self.run_at_key] = run_at.strftime('%FT%XZ')
+            cmd[self.run_at_key] = utils.datetime_to_utc_timestamp(run_at)
             # Update this command
-            self.update_command(device_ID, cmd)
-            logging.debug(f'{self.name}.check updated/replaced {cmd}')
+            if not self.update_command(device_ID, cmd, entity):
+                return
+            logging.debug('%s.check updated/replaced %s', self.name, cmd)
+
+        # All our existing commands just create a notification
+        nd = NotificationData()
+        nd.add(device_ID, cmd_msg, URL=URL, created=created)
 
 
     #--------------------------------------------------------------------------
@@ -277,24 +302,53 @@ class Scheduler:
     def check(self, device_ID: str) -> None:
         # For testing the schedule without waiting for wall clock time,
         # use the offset externally set to adjust the "now" time.
-        now = dt.datetime.utcnow() + dt.timedelta(hours=self.__testing_hours)
-        now_str = now.strftime('%FT%XZ')
-        logging.debug(f'{self.name}.check '
-                f'testing_hours={self.__testing_hours} now={now_str}')
+        utc_now = dt.datetime.utcnow()
+        now = utc_now + dt.timedelta(hours=self.__testing_hours)
+        now_str = utils.datetime_to_utc_timestamp(now)
+        created = utils.datetime_to_utc_timestamp(utc_now) # for notifications
+        logging.debug('%s.check testing_hours=%s now=%s', 
+                self.name, self.__testing_hours, now_str)
 
         # Iterate the schedule entries for device_ID acting upon entries that
         # have a timestamp <= now() 
-        sched_list = self.__get_schedule(device_ID)
-        for cmd in sched_list:
+        # (we read the entities once, so executing and updating a command
+        # doesn't have to look it up again)
+        # The timestamps are fixed format UTC strings, so they sort in time
+        # order and the datastore only returns the commands that are due.
+        entities = datastore.get_sharded_entities_by_data_value(
+                datastore.DS_device_data_KIND, 
+                self.schedule_property, device_ID, 
+                self.run_at_key, now_str, op='<=')
+        for e in entities:
+            cmd = e.get(datastore.DS_DeviceData_data_Property, {})
             cmd_name = cmd.get(self.command_key)
             if cmd_name == None:
                 continue
-            logging.debug(f'{self.name}.checking command={cmd}')
-            # Has the command run at time passed?
-            if now_str >= cmd.get(self.run_at_key):
-                # Yes, so execute it.
-                self.__execute(device_ID, now, cmd)
-
-
-
-
+            logging.debug('%s.checking command=%s', self.name, cmd)
+            # The command run at time has passed, so execute it.
+            # If updating the command fails, it is still due and is run 
+            # again on the next check, so log it and keep going.
+            try:
+                self.__execute(device_ID, now, cmd, e, created)
+            except Exception as ex:
+                logging.error('%s.check %s failed: %s', self.name, cmd_name, ex)
+
+
+# Each field of the command templates, by command, and a new schedule dict
+# for each command (add() copies it and sets the run_at time, and repeat if
+# not the default).  These are set after the class, since a comprehension in
+# the class body can't see the class variables.
+Scheduler.command_messages = {c: d[Scheduler.message_key] 
+        for c, d in Scheduler.commands.items()}
+Scheduler.command_repeat_hours = {c: d[Scheduler.default_repeat_hours_key] 
+        for c, d in Scheduler.commands.items()}
+Scheduler.command_URLs = {c: d[Scheduler.URL_key] 
+        for c, d in Scheduler.commands.items()}
+Scheduler.command_dicts = {c: {
+        Scheduler.command_key: c,
+        Scheduler.message_key: Scheduler.command_messages[c],
+        Scheduler.run_at_key:  None,
+        Scheduler.repeat_key:  Scheduler.command_repeat_hours[c],
+        Scheduler.count_key:   0,
+        Scheduler.URL_key:     Scheduler.command_URLs[c]}
+    for c in Scheduler.commands}
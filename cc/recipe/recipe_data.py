@@ -6,8 +6,7 @@
     - Stores recipes in bigquery for historical tracking.
 """
 
-from datetime import datetime as dt, timedelta
-import os, json, logging, uuid, pprint, io
+import os, json, logging, uuid
 
 from typing import List, Dict
 
@@ -18,6 +17,49 @@ from cloud_common.cc.google import bigquery
 
 class RecipeData:
 
+    # The parts of a generated recipe that are the same in every recipe.
+    # Never modified, each recipe starts with a (shallow) copy of it.
+    # (the None values are set per recipe, they keep the key order)
+    __template_recipe = {
+        "format": "openag-phased-environment-v1",
+        "version": "4.0.1",
+        "creation_timestamp_utc": None,
+        "name": None,
+        "uuid": None,
+        "parent_recipe_uuid": None,
+        "support_recipe_uuids": None,
+        "description": {
+            "brief": "Created by recipe generator service",
+            "verbose": "Created by recipe generator service",
+        },
+        "authors": [],
+        "cultivars": [],
+        "cultivation_methods": [],
+        "environments": None,
+        "phases": None,
+    }
+
+    # The (arable) weather data light band keys, in arable_spectrum order.
+    __light_band_names = ("light_band1_w_m2",
+                          "light_band2_w_m2",
+                          "light_band3_w_m2",
+                          "light_band4_w_m2",
+                          "light_band5_w_m2",
+                          "light_band6_w_m2",
+                          "light_band7_w_m2")
+
+    # Use this for now, until we calibrate the LGHC COB and make an
+    # LED peripheral setup with the spectrum mappings for it.
+    # (never modified, so every manual environment shares it)
+    __PFC_sun_spectrum = {
+        "380-399": 2.03, 
+        "400-499": 20.3,
+        "500-599": 23.27, 
+        "600-700": 31.09, 
+        "701-780": 23.31
+    }
+
+
     #--------------------------------------------------------------------------
     def __init__(self) -> None:
         self.__name = os.path.basename(__file__)
@@ -34,7 +76,7 @@ class RecipeData:
     def read_config(self) -> dict:
         entity = datastore.get_by_key_from_DS(self.__kind, self.__key)
         json_config = entity[self.__key]
-        config_dict = json.loads(utils.bytes_to_string(json_config))
+        config_dict = utils.json_loads(json_config) # str or bytes
         return config_dict
 
 
@@ -42,7 +84,7 @@ class RecipeData:
     # Write the application configuration info to datastore and to bigquery
     # (for historical change tracking). 
     def write_config(self, config: dict) -> None:
-        now = dt.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        now = utils.utc_timestamp()
         config['timestamp'] = now
         ret = self.__save_DS(config)
 
@@ -95,6 +137,19 @@ class RecipeData:
             return False
 
 
+    #--------------------------------------------------------------------------
+    # Private: returns a new recipe dict from the template, with no 
+    # environments or phases.
+    def __new_recipe_dict(self, recipe_name: str) -> dict:
+        recipe = self.__template_recipe.copy()
+        recipe["creation_timestamp_utc"] = utils.utc_timestamp()
+        recipe["name"] = recipe_name
+        recipe["uuid"] = str(uuid.uuid4())
+        recipe["environments"] = {}
+        recipe["phases"] = []
+        return recipe
+
+
     #--------------------------------------------------------------------------
     # Create and return a recipe.
     def create_recipe(self, 
@@ -113,35 +168,17 @@ class RecipeData:
                     'in generated recipe.  The data recorded over an hour '
                     'will run in one minute in real time')
 
-        template_recipe_dict = {
-            "format": "openag-phased-environment-v1",
-            "version": "4.0.1",
-            "creation_timestamp_utc": dt.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "name": recipe_name,
-            "uuid": str(uuid.uuid4()),
-            "parent_recipe_uuid": None,
-            "support_recipe_uuids": None,
-            "description": {
-                "brief": "Created by recipe generator service",
-                "verbose": "Created by recipe generator service",
-            },
-            "authors": [],
-            "cultivars": [],
-            "cultivation_methods": [],
-            "environments": {},
-            "phases": [],
-        }
+        template_recipe_dict = self.__new_recipe_dict(recipe_name)
 
         # Iterate the weather data:
-        logging.info(f'YYYY-MM-DD_HH:MM Temp   RH     PAR ')
+        logging.info('YYYY-MM-DD_HH:MM Temp   RH     PAR ')
         last_date = ''
         last_ts = None
         phase = {}
         # Iterate in date order (earliest to latest), this requires looping
         # through the data array in reverse order.
-        for i in range(len(weather_data) - 1, -1, -1): # start, end, step
-            w = weather_data[i]
-            ts = dt.strptime(w['time'], '%Y-%m-%dT%H:%M:%SZ')
+        for w in reversed(weather_data):
+            ts = utils.utc_timestamp_to_datetime(w['time']) # not strptime()
 
             # If this is the first row / time, then just save the ts.
             if last_ts is None:
@@ -171,17 +208,8 @@ class RecipeData:
             temp = w['air_temp_degrees_C']
             RH = w['air_RH_percent']
             PAR = w['light_PAR_uE_m2_s']
-            light_bands = []
-            light_band_names = ["light_band1_w_m2",
-                                "light_band2_w_m2",
-                                "light_band3_w_m2",
-                                "light_band4_w_m2",
-                                "light_band5_w_m2",
-                                "light_band6_w_m2",
-                                "light_band7_w_m2"]
-
-            for band_name in light_band_names:
-                light_bands.append(w[band_name])
+            light_bands = [w[band_name] for band_name in 
+                    self.__light_band_names]
 
             # convert actual measurements into a 'composition' summing to 100%
             total_light_val = sum(light_bands)
@@ -194,7 +222,7 @@ class RecipeData:
                                "691-740": light_bands_pct[4],
                                "780-900": light_bands_pct[5],
                                "930-960": light_bands_pct[6]}
-            logging.info(f'{name} {temp:4.2f} {RH:6.2f} {PAR:7.2f}')
+            logging.info('%s %4.2f %6.2f %7.2f', name, temp, RH, PAR) # lazy
 
             # Add a named environment 
             template_recipe_dict["environments"][name] = {
@@ -238,21 +266,6 @@ class RecipeData:
         # getting more data)
         phase["repeat"] = times_to_repeat_last_day_in_recipe
 
-        '''
-        # For debugging, comment out for production
-        recipe_file = 'recipe.raw' # to make sure date ordering is correct
-        with open(recipe_file, 'w') as f:
-            f.write(json.dumps(template_recipe_dict))
-        recipe_file = 'recipe.json'
-        with open(recipe_file, 'w') as f: # print dict to file
-            pp = pprint.PrettyPrinter(stream=f) # pretty print SORTs keys!
-            pp.pprint(template_recipe_dict)
-        stream = io.StringIO(open(recipe_file).read().replace('\'', '"'))
-        with open(recipe_file, 'w') as f:   # make it real JSON ' -> "
-            f.write(stream.getvalue())
-        logging.info(f'{self.__name} wrote {recipe_file}')
-        '''
-
         # return the JSON recipe 
         return json.dumps(template_recipe_dict)
 
@@ -263,39 +276,13 @@ class RecipeData:
             manual_air_humidity_percent: float,
             manual_light_ppfd_umol_m2_s: int,
             light_illumination_distance_cm: int) -> str:
-        template_recipe_dict = {
-            "format": "openag-phased-environment-v1",
-            "version": "4.0.1",
-            "creation_timestamp_utc": dt.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "name": "Manual set point recipe",
-            "uuid": str(uuid.uuid4()),
-            "parent_recipe_uuid": None,
-            "support_recipe_uuids": None,
-            "description": {
-                "brief": "Created by recipe generator service",
-                "verbose": "Created by recipe generator service",
-            },
-            "authors": [],
-            "cultivars": [],
-            "cultivation_methods": [],
-            "environments": {},
-            "phases": [],
-        }
-
-        # Use this for now, until we calibrate the LGHC COB and make an
-        # LED peripheral setup with the spectrum mappings for it.
-        PFC_sun_spectrum = {
-            "380-399": 2.03, 
-            "400-499": 20.3,
-            "500-599": 23.27, 
-            "600-700": 31.09, 
-            "701-780": 23.31
-        }
+        template_recipe_dict = self.__new_recipe_dict(
+                "Manual set point recipe")
 
         # Add a named environment 
         template_recipe_dict["environments"]["manual"] = {
             "name": "manual",
-            "light_spectrum_nm_percent": PFC_sun_spectrum,
+            "light_spectrum_nm_percent": self.__PFC_sun_spectrum,
             "light_ppfd_umol_m2_s": manual_light_ppfd_umol_m2_s, 
             "light_illumination_distance_cm": light_illumination_distance_cm, 
             "air_temperature_celsius": manual_air_temperature_celsius,
@@ -1,7 +1,16 @@
 import string
 import random
+import threading
+import time
+import json
 from datetime import datetime, timezone
 
+# Use the (much faster) orjson for parsing JSON if it is installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 #------------------------------------------------------------------------------
 def is_expired(expiration_date):
     """Returns whether something has expired
@@ -31,4 +40,102 @@ def bytes_to_string(bs):
     return bs
 
 
+#------------------------------------------------------------------------------
+# Returns the python object from a JSON str or bytes.
+# (the parser is picked once here, not on every call)
+# orjson rejects the NaN / Infinity tokens that json.dumps() writes, so 
+# anything orjson can't parse is tried again with json.
+if orjson is not None:
+    def json_loads(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s)
+else:
+    json_loads = json.loads
+
+
+#------------------------------------------------------------------------------
+# Returns a datetime from a UTC timestamp string in our '%Y-%m-%dT%H:%M:%SZ'
+# format.  Much faster than strptime(), which interprets the format string on
+# every call.  (datetime.fromisoformat() is not available in python3.6.)
+# Raises ValueError if the string is not in this exact format.
+def utc_timestamp_to_datetime(ts):
+    if len(ts) != 20 or ts[4] != '-' or ts[7] != '-' or ts[10] != 'T' or \
+            ts[13] != ':' or ts[16] != ':' or ts[19] != 'Z':
+        raise ValueError(f'invalid UTC timestamp {ts}')
+    return datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                    int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))
+
+
+#------------------------------------------------------------------------------
+# Returns the current UTC time as a '%Y-%m-%dT%H:%M:%SZ' timestamp string.
+# The string only changes once a second, so it is formatted once a second
+# and reused (messages arrive in bursts).
+__last_utc_timestamp = (None, None) # (epoch second, timestamp string)
+
+def utc_timestamp():
+    global __last_utc_timestamp
+    now = int(time.time())
+    sec, ts = __last_utc_timestamp
+    if now != sec:
+        ts = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now))
+        __last_utc_timestamp = (now, ts) # one assignment, thread safe
+    return ts
+
+
+#------------------------------------------------------------------------------
+# Returns a naive UTC datetime as a '%Y-%m-%dT%H:%M:%SZ' timestamp string.
+# Formats the fields directly, which is faster than strftime().
+def datetime_to_utc_timestamp(d):
+    return f'{d.year:04d}-{d.month:02d}-{d.day:02d}T' \
+           f'{d.hour:02d}:{d.minute:02d}:{d.second:02d}Z'
+
+
+#------------------------------------------------------------------------------
+# A small thread safe cache, whose entries expire ttl seconds after they are
+# set.  Expired entries are dropped when anything is set, and when full, the
+# entry that will expire first is dropped.
+class TTLCache:
+
+    def __init__(self, maxsize=1000, ttl=5):
+        self.__maxsize = maxsize
+        self.__ttl = ttl
+        self.__entries = {} # key: (expires_at, value)
+        self.__lock = threading.Lock()
+
+    # Returns the cached value, or default if missing or expired.
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self.__entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self.__lock:
+            now = time.monotonic()
+            entries = self.__entries
+            entries.pop(key, None) # move to the end
+            # Entries are in insertion order and share one ttl, so they are
+            # also in expiry order.  Drop the expired ones from the front, 
+            # then the oldest while we are full.
+            while entries:
+                first = next(iter(entries))
+                if entries[first][0] >= now and \
+                        len(entries) < self.__maxsize:
+                    break
+                del entries[first]
+            entries[key] = (now + self.__ttl, value)
+
+    # Removes the entry for key, if there is one.
+    def pop(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
 
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
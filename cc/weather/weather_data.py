@@ -7,9 +7,11 @@
 
 from datetime import datetime as dt, timedelta
 import os, json, logging
+from operator import itemgetter
 
 from typing import Dict, List
 
+from cloud_common.cc import utils 
 from cloud_common.cc.google import env_vars 
 from cloud_common.cc.google import datastore
 from cloud_common.cc.google import bigquery
@@ -52,21 +54,33 @@ class WeatherData:
         # The datastore caches all data points from each device 
         rows = datastore.get_sharded_entity_range(self.__kind, 'computed',
                 arable_device_name, start_date, end_date) 
-        # Sort by timestamp
-        sorted_rows = []
-        for row in rows:
-            row = json.loads(row)
-            sorted_rows.append(row)
-        sorted_rows = sorted(sorted_rows, key=lambda r: r.get('time'), 
-                reverse=True)
-        # Remove duplicate timestamps
-        previous_ts = None
-        for d in sorted_rows:
-            if d['time'] == previous_ts:
-                sorted_rows.remove(d)
-                continue
-            previous_ts = d['time'] 
-        return sorted_rows # return the (5 min) data 
+        # Each row is a JSON object string, parse them all as one JSON array 
+        # (one call instead of one per row).
+        rows = utils.json_loads('[' + ','.join(rows) + ']')
+        # Remove duplicate timestamps as we go, keeping the first of each.
+        # (the sort is stable, so this is the row the sort would put first)
+        deduped_rows = {}
+        for d in rows:
+            ts = d['time']
+            if ts not in deduped_rows:
+                deduped_rows[ts] = d
+        # Sort by timestamp 
+        return sorted(deduped_rows.values(), key=itemgetter('time'), 
+                reverse=True) # return the (5 min) data 
+
+
+    #--------------------------------------------------------------------------
+    # Return a dict of {'arable_device_name': [rows],...} of the computed 
+    # weather data in the date range, for each device.  
+    # The devices are read in parallel, see datastore.get_in_parallel().
+    # See get_computed_weather_data() for the args and the rows.
+    def get_computed_weather_data_multi(self, 
+            start_date: str, end_date: str, 
+            arable_device_names: List[str],
+            hourly: bool = True) -> Dict[str, List[Dict]]:
+        return datastore.get_in_parallel(arable_device_names,
+                lambda n: self.get_computed_weather_data(start_date, end_date,
+                    n, hourly))
 
 
     #--------------------------------------------------------------------------